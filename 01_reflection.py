@@ -59,6 +59,7 @@
 
 import os
 import json
+import logging
 
 from typing import List, TypedDict, Optional 
 from dotenv import load_dotenv
@@ -72,6 +73,7 @@ from langgraph.graph import StateGraph, END
 from rich.console import Console
 from rich.markdown import Markdown
 from rich.syntax import Syntax
+from agent_logging import get_logger
 
 # --- API密钥和追踪设置 ---
 load_dotenv()
@@ -210,6 +212,8 @@ llm = ChatOpenAI(model="deepseek-ai/DeepSeek-V3.2",
 
 # 初始化控制台以进行漂亮打印
 console = Console()
+# 模型原始输出等调试信息写入日志文件，AGENT_LOG_LEVELS=reflection=DEBUG 时开启
+reflection_log = get_logger("reflection")
 
 print("硅基流动平台LLM和控制台已初始化。")
 
@@ -226,15 +230,16 @@ def generator_node(state):
     """生成代码的初始草稿。"""
     console.print("--- 1. 生成初始草稿 ---")
     
-    # 先测试不使用 structured_output 看原始输出
-    # OpenInference会自动追踪LLM调用，不需要显式设置callbacks
-    test_llm = ChatOpenAI(
-        model="Qwen/Qwen2.5-72B-Instruct",
-        temperature=0.2,
-        base_url="https://api.siliconflow.cn/v1"
-    )
+    # 先测试不使用 structured_output 看原始输出（仅在开启调试日志时执行，这是一次额外的模型调用）
+    if reflection_log.isEnabledFor(logging.DEBUG):
+        # OpenInference会自动追踪LLM调用，不需要显式设置callbacks
+        test_llm = ChatOpenAI(
+            model="Qwen/Qwen2.5-72B-Instruct",
+            temperature=0.2,
+            base_url="https://api.siliconflow.cn/v1"
+        )
     
-    test_prompt = f"""你是一位专业的Python程序员。编写一个Python函数来解决以下请求。
+        test_prompt = f"""你是一位专业的Python程序员。编写一个Python函数来解决以下请求。
 
 ⚠️ 重要要求：
 1. 必须返回一个完整的 Python 函数定义（def 函数名）
@@ -249,8 +254,8 @@ def generator_node(state):
   "explanation": "代码的简要说明"
 }}"""
     
-    test_result = test_llm.invoke(test_prompt)
-    console.print(f"[yellow]调试 - LLM 原始输出:[/yellow]\n{test_result.content}")
+        test_result = test_llm.invoke(test_prompt)
+        reflection_log.debug("LLM 原始输出:\n%s", test_result.content)
     
     # 然后使用手动JSON解析方式获取结构化输出
     prompt = f"""你是一位专业的Python程序员。 编写一个Python函数来解决以下请求。
@@ -288,7 +293,7 @@ def generator_node(state):
                 
     except (json.JSONDecodeError, ValueError) as e:
         console.print(f"[yellow]⚠️ JSON解析错误或数据验证失败: {e}[/yellow]")
-        console.print(f"[yellow]原始响应:[/yellow] {response.content}")
+        reflection_log.debug("原始响应: %s", response.content)
         
         # 使用默认值作为降级策略
         draft_data = {
@@ -363,7 +368,7 @@ def critic_node(state):
             
     except (json.JSONDecodeError, ValueError) as e:
         console.print(f"[yellow]⚠️ JSON解析错误或数据验证失败: {e}[/yellow]")
-        console.print(f"[yellow]原始响应:[/yellow] {response.content}")
+        reflection_log.debug("原始响应: %s", response.content)
         
         # 使用默认值作为降级策略
         critique_data = {
@@ -439,7 +444,7 @@ def refiner_node(state):
                 
     except (json.JSONDecodeError, ValueError) as e:
         console.print(f"[yellow]⚠️ JSON解析错误或数据验证失败: {e}[/yellow]")
-        console.print(f"[yellow]原始响应:[/yellow] {response.content}")
+        reflection_log.debug("原始响应: %s", response.content)
         
         # 使用默认值作为降级策略
         refined_data = {
@@ -687,7 +692,7 @@ def evaluate_code(code_to_evaluate: str):
               
  except (json.JSONDecodeError, ValueError) as e:
      console.print(f"[yellow]⚠️ 评估JSON解析错误: {e}[/yellow]")
-     console.print(f"[yellow]原始响应:[/yellow] {response.content}")
+     reflection_log.debug("原始响应: %s", response.content)
      
      # 使用默认值作为降级策略
      return {
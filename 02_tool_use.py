@@ -31,6 +31,7 @@ from dotenv import load_dotenv
 # LangChain组件
 from langchain_openai import ChatOpenAI
 from langchain_community.tools.tavily_search import TavilySearchResults
+from tool_registry import tool_registry
 from langchain_core.messages import BaseMessage, ToolMessage
 from pydantic import BaseModel, Field
 
@@ -103,11 +104,13 @@ else:
 # 代理的能力取决于它可以访问的工具。在这个阶段，我们将定义并测试我们将提供给代理的特定工具：实时网络搜索。
 
 # 初始化工具。我们可以设置最大result数以保持上下文简洁。
-search_tool = TavilySearchResults(max_results=2)
-
 # for代理提供清晰的工具名称and描述至关重要
-search_tool.name = "web_search"
-search_tool.description = "用于搜索互联网获取最新信息的工具，包括新闻、事件和时事。"
+# 工具通过进程级注册表获取，只构造一次
+search_tool = tool_registry.get("web_search_news", lambda: TavilySearchResults(
+    max_results=2,
+    name="web_search",
+    description="用于搜索互联网获取最新信息的工具，包括新闻、事件和时事。",
+))
 
 tools = [search_tool]
 
@@ -129,10 +132,11 @@ print("AgentState TypedDict已定义，用于管理对话历史。")
 # 将工具绑定到LLM
 llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", 
                  base_url=os.environ.get("OPENAI_API_BASE"),
+                 http_client=tool_registry.http_client(),
                  temperature=0)
 
 # 将工具绑定到LLM，使其具有工具意识
-llm_with_tools = llm.bind_tools(tools)
+llm_with_tools = tool_registry.bind(llm, tools)
 
 print("LLM已与提供的工具绑定。")
 
@@ -81,6 +81,7 @@ logger = logging.getLogger(__name__)
 # LangChain components 
 from langchain_openai import ChatOpenAI
 from langchain_community.tools.tavily_search import TavilySearchResults
+from tool_registry import tool_registry
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
 from pydantic import BaseModel, Field
 
@@ -162,9 +163,9 @@ def web_search_tool(query: str) -> str:
     return str(result)
 
 # 原始工具用于实际搜索
-search_tool = TavilySearchResults(max_results=2, name="web_search")
-llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), temperature=0)
-llm_with_tools = llm.bind_tools([web_search_tool])
+search_tool = tool_registry.get("web_search", lambda: TavilySearchResults(max_results=2, name="web_search"))
+llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), http_client=tool_registry.http_client(), temperature=0)
+llm_with_tools = tool_registry.bind(llm, [web_search_tool])
 
 # def基础代理的代理节点
 def basic_agent_node(state: AgentState):
@@ -95,6 +95,7 @@ from langchain_core.tools import tool
 from langchain_core.messages import SystemMessage
  
 from langchain_tavily import TavilySearch
+from tool_registry import tool_registry
 
 # LangGraph components 
 from langgraph.graph import StateGraph, END
@@ -158,7 +159,7 @@ class AgentState(TypedDict):
  messages: Annotated[list[BaseMessage], add_messages]
 
 # 1. 从tavily包定义基础工具
-tavily_search_tool = TavilySearch(max_results=2)
+tavily_search_tool = tool_registry.get("tavily_search", lambda: TavilySearch(max_results=2))
 
 # 2. Fix: Simplified self-defined tool. 
 # The invoke() method already returns a clean string, so we just pass it through.
@@ -170,11 +171,11 @@ def web_search(query: str) -> str:
  return result
 
 # 3. 定义LLM并将其绑定到我们的自定义工具
-llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), temperature=0)
+llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), http_client=tool_registry.http_client(), temperature=0)
 
 # 直接使用装饰器@tool定义的web_search函数
 tools = [web_search]
-llm_with_tools = llm.bind_tools(tools)
+llm_with_tools = tool_registry.bind(llm, tools)
 
 # 4. 带有系统提示的代理节点，强制一次调用一个工具
 def react_agent_node(state: AgentState):
@@ -378,6 +379,10 @@ class PlanningState(TypedDict):
  plan: Optional[List[str]]
  intermediate_steps: List[ToolMessage]
  final_answer: Optional[str]
+ # 已执行的查询（用于检查点去重）
+ executed_queries: Optional[List[str]]
+ # 检查点统计：检查次数、模型调用次数、节省的步骤数
+ replan_stats: Optional[dict]
 
 def planner_node(state: PlanningState):
  """生成行动计划以回答用户的请求。"""
@@ -410,19 +415,21 @@ def planner_node(state: PlanningState):
  console.print(f"--- 规划器：生成的计划： {plan_result.steps} ---")
  return {"plan": plan_result.steps}
 
+def parse_plan_step(step: str):
+ """将计划步骤解析为(工具名, 查询)。"""
+ # Robust regex to handle both single and double quotes
+ match = re.search(r"(\w+)\((?:\"|\')(.*?)(?:\"|\')\)", step)
+ if not match:
+    return "web_search", step
+ return match.groups()[0], match.groups()[1]
+
 def executor_node(state: PlanningState):
  """执行计划中的下一步。"""
  console.print("--- 执行器：运行下一步... ---")
  plan = state["plan"]
  next_step = plan[0]
  
- # Robust regex to handle both single and double quotes
- match = re.search(r"(\w+)\((?:\"|\')(.*?)(?:\"|\')\)", next_step)
- if not match:
-    tool_name = "web_search"
-    query = next_step
- else:
-    tool_name, query = match.groups()[0], match.groups()[1]
+ tool_name, query = parse_plan_step(next_step)
  
  console.print(f"--- 执行器：调用工具 '{tool_name}' with query '{query}' ---")
  
@@ -437,7 +444,8 @@ def executor_node(state: PlanningState):
  
  return{
  "plan": plan[1:], # Pop the executed stepfromthe plan
- "intermediate_steps": state["intermediate_steps"] + [tool_message]
+ "intermediate_steps": state["intermediate_steps"] + [tool_message],
+ "executed_queries": (state.get("executed_queries") or []) + [query]
  }
 
 def synthesizer_node(state: PlanningState):
@@ -455,7 +463,79 @@ def synthesizer_node(state: PlanningState):
  final_answer = llm.invoke(prompt).content
  return {"final_answer": final_answer}
 
-print("规划器、执行器和综合器节点已定义。")
+# --- 执行中检查点：每执行一步后判断剩余步骤是否仍然需要 ---
+# 规则优先（去重已执行的查询），只有在规则无法判断时才调用一个便宜的小模型。
+class PlanCheck(BaseModel):
+ """检查点对剩余计划的判断。"""
+ action: str = Field(description="'continue'（保持剩余步骤）、'revise'（用remaining_steps替换剩余步骤）或'finish'（已收集到足够信息，直接综合）之一。")
+ remaining_steps: List[str] = Field(default_factory=list, description="当action为'revise'时新的剩余步骤，每一步都是对`web_search`的单次调用。")
+ reasoning: str = Field(description="判断的简要理由。")
+
+# 检查点使用更小、更便宜的模型
+checker_llm = ChatOpenAI(model="Qwen/Qwen2.5-7B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), http_client=tool_registry.http_client(), temperature=0)
+# 每次运行中检查点最多调用模型的次数，超过后只使用规则
+MAX_CHECKPOINT_LLM_CALLS = 3
+
+def plan_review_node(state: PlanningState):
+ """在每个已执行步骤之后检查剩余计划：可截断、改写尾部或提前结束。"""
+ stats = dict(state.get("replan_stats") or {"checks": 0, "llm_calls": 0, "steps_saved": 0, "early_stop": False})
+ stats["checks"] += 1
+ remaining = list(state["plan"] or [])
+
+ if not remaining:
+  return {"replan_stats": stats}
+
+ # 规则1：丢弃与已执行查询重复的剩余步骤
+ executed = {q.strip().lower() for q in (state.get("executed_queries") or [])}
+ deduped = [step for step in remaining if parse_plan_step(step)[1].strip().lower() not in executed]
+ if len(deduped) < len(remaining):
+  console.print(f"--- 检查点：规则移除了 {len(remaining) - len(deduped)} 个重复步骤 ---")
+  stats["steps_saved"] += len(remaining) - len(deduped)
+  remaining = deduped
+ if not remaining:
+  return {"plan": [], "replan_stats": stats}
+
+ # 规则2：预算用尽时保持原计划
+ if stats["llm_calls"] >= MAX_CHECKPOINT_LLM_CALLS:
+  return {"plan": remaining, "replan_stats": stats}
+
+ context = "\n".join([f"Tool {msg.name} returned: {msg.content}" for msg in state["intermediate_steps"]])
+ prompt = f"""你是一名计划审查员。根据已收集的数据，判断剩余的计划步骤是否仍然需要。
+- 如果已收集的数据已经足以回答用户的请求，返回'finish'。
+- 如果某些剩余步骤已经不需要或需要调整，返回'revise'并给出新的剩余步骤（格式与原步骤相同）。
+- 否则返回'continue'。
+
+**用户的请求：**
+{state['user_request']}
+
+**已收集的数据：**
+{context}
+
+**剩余步骤：**
+{remaining}
+"""
+ stats["llm_calls"] += 1
+ try:
+  check = checker_llm.with_structured_output(PlanCheck).invoke(prompt)
+ except Exception as e:
+  console.print(f"--- 检查点：判断失败，保持原计划: {e} ---")
+  return {"plan": remaining, "replan_stats": stats}
+
+ console.print(f"--- 检查点：{check.action}。原因：{check.reasoning} ---")
+ if check.action == "finish":
+  stats["steps_saved"] += len(remaining)
+  stats["early_stop"] = True
+  return {"plan": [], "replan_stats": stats}
+ if check.action == "revise":
+  if len(check.remaining_steps) > len(remaining):
+   # 检查点只能缩短或改写计划；变长的改写整体拒绝，而不是截断后悄悄丢掉审查员新增的步骤
+   console.print(f"--- 检查点：改写后有 {len(check.remaining_steps)} 步，多于剩余的 {len(remaining)} 步，保持原计划 ---")
+   return {"plan": remaining, "replan_stats": stats}
+  stats["steps_saved"] += len(remaining) - len(check.remaining_steps)
+  return {"plan": check.remaining_steps, "replan_stats": stats}
+ return {"plan": remaining, "replan_stats": stats}
+
+print("规划器、执行器、检查点和综合器节点已定义。")
 
 
 # ### 步骤2.2： 构建规划代理图
@@ -477,11 +557,13 @@ def planning_router(state: PlanningState):
 planning_graph_builder = StateGraph(PlanningState)
 planning_graph_builder.add_node("plan", planner_node)
 planning_graph_builder.add_node("execute", executor_node)
+planning_graph_builder.add_node("review", plan_review_node)
 planning_graph_builder.add_node("synthesize", synthesizer_node)
 
 planning_graph_builder.set_entry_point("plan")
 planning_graph_builder.add_conditional_edges("plan", planning_router, {"execute": "execute", "synthesize": "synthesize"}) # 规划后路由...
-planning_graph_builder.add_conditional_edges("execute", planning_router, {"execute": "execute", "synthesize": "synthesize"})
+planning_graph_builder.add_edge("execute", "review") # 每执行一步后检查剩余计划
+planning_graph_builder.add_conditional_edges("review", planning_router, {"execute": "execute", "synthesize": "synthesize"})
 planning_graph_builder.add_edge("synthesize", END)
 
 planning_agent_app = planning_graph_builder.compile()
@@ -507,6 +589,7 @@ try:
     __start__ [shape=point];
     plan [label="plan", style=filled, fillcolor="#f2f0ff"];
     execute [label="execute", style=filled, fillcolor="#f2f0ff"];
+    review [label="review", style=filled, fillcolor="#f2f0ff"];
     synthesize [label="synthesize", style=filled, fillcolor="#f2f0ff"];
     __end__ [label="__end__", shape=doublecircle, style=filled, fillcolor="#bfb6fc"];
     
@@ -514,8 +597,9 @@ try:
     __start__ -> plan;
     plan -> execute [label="有步骤需要执行"];
     plan -> synthesize [label="计划完成"];
-    execute -> execute [label="继续执行"];
-    execute -> synthesize [label="计划完成"];
+    execute -> review;
+    review -> execute [label="继续执行"];
+    review -> synthesize [label="计划完成或提前结束"];
     synthesize -> __end__;
 }
 """
@@ -556,6 +640,10 @@ final_planning_output = planning_agent_app.invoke(initial_planning_input)
 console.print("\n--- [bold green]规划代理的最终输出[/bold green] ---")
 console.print(Markdown(final_planning_output['final_answer']))
 
+# 检查点的开销（模型调用）与节省的步骤对比
+replan_stats = final_planning_output.get("replan_stats") or {}
+console.print(f"--- 检查点统计：检查 {replan_stats.get('checks', 0)} 次，模型调用 {replan_stats.get('llm_calls', 0)} 次，节省步骤 {replan_stats.get('steps_saved', 0)} 个，提前结束: {replan_stats.get('early_stop', False)} ---")
+
 
 # **输出讨论：**
 # 过程的差异立即显现。第一步就是`规划器`创建完整、明确的计划：`['web_search("population of Paris")', 'web_search("population of Berlin")']`. 
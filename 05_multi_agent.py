@@ -71,8 +71,18 @@ from dotenv import load_dotenv
 
 
 import os
+import json
+import time
+import random
+import re
+import hashlib
+import sqlite3
+import operator
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 
-from typing import List, Annotated, TypedDict, Optional
+from typing import List, Annotated, TypedDict, Optional, Dict, Any
 
 
 from dotenv import load_dotenv
@@ -90,12 +100,15 @@ logger = logging.getLogger(__name__)
 from langchain_openai import ChatOpenAI
 # 
 from langchain_tavily import TavilySearch
+from tool_registry import tool_registry
+from agent_logging import get_logger
 
 # 硅基流动平台组件
 
 from langchain_community.tools.tavily_search import TavilySearchResults
 
-from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
 
 
 from pydantic import BaseModel, Field
@@ -104,7 +117,8 @@ from langchain_core.prompts import ChatPromptTemplate
 
 # LangGraph components
 
-from langgraph.graph import StateGraph, END
+from langgraph.graph import StateGraph, START, END
+from report_streaming import stream_report, stream_with_report_events
 
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
@@ -197,15 +211,21 @@ print("环境变量已加载，追踪已设置.")
 
 
 console = Console()
+# 设置RUN_WATCHLIST_BATCH时只运行阶段5的观察列表批量模式，跳过各阶段的演示运行
+RUN_WATCHLIST_BATCH = bool(os.environ.get("RUN_WATCHLIST_BATCH"))
+# 分级日志：统计、重试和失败细节写入日志，控制台只保留流程进度和最终输出
+multi_agent_log = get_logger("multi_agent")
+specialist_log = get_logger("multi_agent.specialist")
+batch_log = get_logger("multi_agent.batch")
 
 # 为两个代理定义共享状态
 class AgentState(TypedDict):
  messages: Annotated[list[BaseMessage], add_messages]
 
 # 定义工具和LLM
-search_tool = TavilySearch(max_results=3, name="web_search")
-llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), temperature=0)
-llm_with_tools = llm.bind_tools([search_tool])
+search_tool = tool_registry.get("web_search_top3", lambda: TavilySearch(max_results=3, name="web_search"))
+llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), http_client=tool_registry.http_client(), temperature=0)
+llm_with_tools = tool_registry.bind(llm, [search_tool])
 
 # 定义单体代理节点
 def mono_agent_node(state: AgentState):
@@ -319,17 +339,19 @@ except Exception as e:
 company = "NVIDIA (NVDA)"
 mono_query = f"为...创建简短但全面的市场分析报告 {company}. 报告应包括三个 sections: 1. A summary 的recent news 和市场情绪. 2. 股票的基本技术分析's price trend. 3. 查看公司最近的财务表现."
 
-console.print(f"[bold yellow]测试单体代理在多方面任务上:[/bold yellow]\n'{mono_query}'\n")
+# 批量模式下跳过演示运行
+if not RUN_WATCHLIST_BATCH:
+    console.print(f"[bold yellow]测试单体代理在多方面任务上:[/bold yellow]\n'{mono_query}'\n")
 
-final_mono_output = mono_agent_app.invoke({
- "messages": [
- SystemMessage(content="你是一个single, 专业财务分析师. 你必须创建全面的报告，涵盖用户请求的所有方面."),
- HumanMessage(content=mono_query)
- ]
-})
+    final_mono_output = mono_agent_app.invoke({
+     "messages": [
+     SystemMessage(content="你是一个single, 专业财务分析师. 你必须创建全面的报告，涵盖用户请求的所有方面."),
+     HumanMessage(content=mono_query)
+     ]
+    })
 
-console.print("\n--- [bold red]来自单体代理的最终报告[/bold red] ---")
-console.print(Markdown(final_mono_output['messages'][-1].content))
+    console.print("\n--- [bold red]来自单体代理的最终报告[/bold red] ---")
+    console.print(Markdown(final_mono_output['messages'][-1].content))
 
 
 # **输出讨论:**
@@ -352,13 +374,207 @@ console.print(Markdown(final_mono_output['messages'][-1].content))
 # In[ ]:
 
 
+def merge_dicts(left: Optional[dict], right: Optional[dict]) -> dict:
+    """并行节点各自写入自己的键，合并时保留双方。"""
+    return {**(left or {}), **(right or {})}
+
 # 我们的多代理系统的状态将保存每个专家的输出
 class MultiAgentState(TypedDict):
  user_request: str
+ # 报告针对的公司，用作分节缓存的键（为空时不使用缓存）
+ company: Optional[str]
  news_report: Optional[str]
  technical_report: Optional[str]
  financial_report: Optional[str]
  final_report: Optional[str]
+ # 并行专家中失败或超时的部分（多个专家可能同时写入，因此使用累加reducer）
+ failed_sections: Annotated[List[str], operator.add]
+ # 每个专家的模型调用次数、工具调用次数、迭代次数和令牌数
+ specialist_stats: Annotated[dict, merge_dicts]
+ # 报告撰写者的首令牌时间和末令牌时间（秒）
+ writer_timing: Optional[dict]
+ # 本次调用共享的证据池（EvidenceStore），由prepare_evidence节点创建一次，所有专家和报告撰写者共用
+ evidence_store: Optional[Any]
+
+# 每个专家的超时时间（秒）
+SPECIALIST_TIMEOUT = float(os.environ.get("SPECIALIST_TIMEOUT", "120"))
+# 专家调用在共享线程池中运行，这样超时的调用不会阻塞图的其余部分
+# （批量模式下多个报告同时运行，线程池需要容纳 3 × 并发报告数）
+specialist_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SPECIALIST_POOL_SIZE", "32")), thread_name_prefix="specialist")
+
+# 超时后的取消：线程无法被强行中断，future.cancel() 对已经开始运行的专家也不起作用。
+# 因此超时时设置该专家的取消事件，工作线程在每次模型调用和每次搜索之前检查它并抛出 SpecialistCancelled。
+# 正在进行的那一次调用会跑完（结果被丢弃），之后不再发起新的调用，线程池的槽位最多再被占用一次调用的时间，
+# 反复超时不会让线程池被放弃的专家耗尽。
+class SpecialistCancelled(Exception):
+    """专家已超时，其调用方不再等待结果。"""
+# 专家内部的工具循环上限：最多迭代次数和累计令牌数
+MAX_TOOL_ITERATIONS = int(os.environ.get("MAX_TOOL_ITERATIONS", "3"))
+MAX_SPECIALIST_TOKENS = int(os.environ.get("MAX_SPECIALIST_TOKENS", "12000"))
+# 同一轮中请求的多个搜索并发执行（与专家线程池分开，避免嵌套提交导致线程池耗尽）
+search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")
+
+# --- 每次运行的共享证据池 ---
+# 三个专家经常搜索同一家公司的重叠页面. 所有搜索都经过证据池:
+# 相同或近似相同的查询在进行中时被合并, 检索到的文档按URL/内容哈希去重,
+# 专家在每轮工具循环前重新读取兄弟专家已经获取的证据, 报告撰写者引用统一的来源集合.
+# 报告正文中的来源引用，编号与EvidenceStore.render()/sources()一致
+CITATION_PATTERN = re.compile(r"\[(\d+)\]")
+
+def normalize_query(query: str) -> str:
+    """规范化查询：小写、去标点、词集合排序，使近似相同的查询得到同一个键。"""
+    cleaned = "".join(c if c.isalnum() else " " for c in query.lower())
+    return " ".join(sorted(set(cleaned.split())))
+
+class EvidenceStore:
+    """单次运行内的证据池，线程安全（并行专家共享同一个实例）。"""
+
+    def __init__(self, shared_cache: Optional[dict] = None):
+        self._lock = threading.Lock()
+        # 规范化查询 -> Future（进行中或已完成的搜索）
+        self._queries = {}
+        # 文档键（URL或内容哈希）-> 文档
+        self._documents = {}
+        # 跨运行共享的搜索缓存（批量模式使用）
+        self._shared_cache = shared_cache
+        self.stats = {"requested": 0, "executed": 0, "coalesced": 0, "duplicate_documents": 0}
+
+    def search(self, query: str) -> List[dict]:
+        """通过证据池执行搜索，返回本次查询的文档列表。"""
+        key = normalize_query(query)
+        with self._lock:
+            self.stats["requested"] += 1
+            future = self._queries.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._queries[key] = future
+            else:
+                self.stats["coalesced"] += 1
+        if not owner:
+            return future.result()
+
+        try:
+            if self._shared_cache is not None and key in self._shared_cache:
+                raw = self._shared_cache[key]
+            else:
+                raw = search_tool.invoke({"query": query})
+                with self._lock:
+                    self.stats["executed"] += 1
+                if self._shared_cache is not None:
+                    self._shared_cache[key] = raw
+            documents = self._add_documents(raw)
+        except Exception as e:
+            with self._lock:
+                # 失败的查询不缓存，后续请求可以重试
+                self._queries.pop(key, None)
+            future.set_exception(e)
+            raise
+        future.set_result(documents)
+        return documents
+
+    def _add_documents(self, raw) -> List[dict]:
+        if isinstance(raw, str):
+            try:
+                raw = json.loads(raw)
+            except json.JSONDecodeError:
+                raw = {"results": [{"url": "", "title": "", "content": raw}]}
+        results = raw.get("results", []) if isinstance(raw, dict) else list(raw or [])
+        documents = []
+        with self._lock:
+            for item in results:
+                content = item.get("content", "")
+                doc_key = item.get("url") or hashlib.sha1(content.encode("utf-8")).hexdigest()
+                if doc_key in self._documents:
+                    self.stats["duplicate_documents"] += 1
+                else:
+                    self._documents[doc_key] = {"url": item.get("url", ""), "title": item.get("title", ""), "content": content}
+                documents.append(self._documents[doc_key])
+        return documents
+
+    def documents(self) -> List[dict]:
+        with self._lock:
+            return list(self._documents.values())
+
+    def render(self, documents: Optional[List[dict]] = None, max_chars: int = 500) -> str:
+        """将文档渲染为带编号的文本，编号与sources()一致，便于引用。"""
+        all_docs = self.documents()
+        index = {id(doc): i + 1 for i, doc in enumerate(all_docs)}
+        docs = all_docs if documents is None else documents
+        return "\n\n".join(f"[{index.get(id(doc), '?')}] {doc['title']} ({doc['url']})\n{doc['content'][:max_chars]}" for doc in docs)
+
+    def sources(self) -> str:
+        return "\n".join(f"[{i + 1}] {doc['title']} - {doc['url']}" for i, doc in enumerate(self.documents()))
+
+    def cited_documents(self, content: str) -> Dict[int, dict]:
+        """正文中引用的编号 -> 本证据池中对应的文档，用于和报告部分一起缓存。"""
+        numbered = dict(enumerate(self.documents(), start=1))
+        return {n: numbered[n] for n in sorted({int(m) for m in CITATION_PATTERN.findall(content)}) if n in numbered}
+
+    def restore_citations(self, content: str, cited: Dict[int, dict]) -> str:
+        """把缓存部分引用的文档加入本证据池，并把正文中的旧编号改写为本次运行的编号，与sources()一致。"""
+        if not cited:
+            return content
+        old_numbers = list(cited)
+        added = self._add_documents({"results": [cited[n] for n in old_numbers]})
+        numbers = {id(doc): i + 1 for i, doc in enumerate(self.documents())}
+        mapping = {old: numbers[id(doc)] for old, doc in zip(old_numbers, added)}
+        return CITATION_PATTERN.sub(lambda m: f"[{mapping.get(int(m.group(1)), m.group(1))}]", content)
+
+# --- 分节缓存：按(公司, 部分)持久化专家输出，每个部分有自己的TTL ---
+# 财务基本面很少变化，技术面变化较慢，新闻变化最快. 刷新报告时只重跑过期的部分.
+SECTION_TTLS = {
+    "news_report": int(os.environ.get("NEWS_TTL_SECONDS", str(60 * 60))),
+    "technical_report": int(os.environ.get("TECHNICAL_TTL_SECONDS", str(6 * 60 * 60))),
+    "financial_report": int(os.environ.get("FINANCIAL_TTL_SECONDS", str(7 * 24 * 60 * 60))),
+}
+
+class SectionCache:
+    """基于SQLite的分节缓存，线程安全。每个部分连同它引用的证据文档一起保存，
+    缓存命中时文档重新加入本次运行的证据池，引用编号随之改写，报告撰写者的来源列表才能对上。"""
+
+    def __init__(self, path: str = "report_sections.db"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sections (company TEXT, section TEXT, content TEXT, created_at REAL, documents TEXT, PRIMARY KEY (company, section))")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sections)")}
+        if "documents" not in columns:
+            self._conn.execute("ALTER TABLE sections ADD COLUMN documents TEXT")
+        self._conn.commit()
+
+    def get(self, company: str, section: str) -> Optional[tuple]:
+        """返回(内容, 年龄秒数, 引用编号 -> 文档)；不存在、已过期或没有保存引用文档（旧格式）时返回None。"""
+        with self._lock:
+            row = self._conn.execute("SELECT content, created_at, documents FROM sections WHERE company = ? AND section = ?", (company.lower(), section)).fetchone()
+        if row is None or row[2] is None:
+            return None
+        age = time.time() - row[1]
+        if age > SECTION_TTLS.get(section, 0):
+            return None
+        return row[0], age, {int(n): doc for n, doc in json.loads(row[2])}
+
+    def put(self, company: str, section: str, content: str, cited: Dict[int, dict]):
+        documents = json.dumps([[n, doc] for n, doc in cited.items()], ensure_ascii=False)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sections (company, section, content, created_at, documents) VALUES (?, ?, ?, ?, ?)",
+                               (company.lower(), section, content, time.time(), documents))
+            self._conn.commit()
+
+    def invalidate(self, company: str, section: Optional[str] = None):
+        with self._lock:
+            if section is None:
+                self._conn.execute("DELETE FROM sections WHERE company = ?", (company.lower(),))
+            else:
+                self._conn.execute("DELETE FROM sections WHERE company = ? AND section = ?", (company.lower(), section))
+            self._conn.commit()
+
+section_cache = SectionCache(os.environ.get("SECTION_CACHE_PATH", "report_sections.db"))
+
+def prepare_evidence_node(state: MultiAgentState, config: RunnableConfig):
+    """每次调用只创建一次证据池并放入状态：优先使用运行配置中传入的（批量模式带共享搜索缓存），否则新建。
+    三个并行专家和报告撰写者都从状态中读取同一个实例。"""
+    store = ((config or {}).get("configurable") or {}).get("evidence_store")
+    return {"evidence_store": store if store is not None else EvidenceStore()}
 
 def create_specialist_node(persona: str, output_key: str):
     """创建专家代理节点的工厂函数."""
@@ -367,16 +583,92 @@ def create_specialist_node(persona: str, output_key: str):
     # ✅ 构建ChatPromptTemplate而不是普通列表
     prompt_template = ChatPromptTemplate.from_messages([
         ("system", system_prompt),
-        ("human", "{user_request}")
+        ("human", "{user_request}\n\n其他专家已获取的证据（可直接使用，避免重复搜索）:\n{evidence}")
     ])
 
-    agent = prompt_template | llm_with_tools
+    def run_tool_call(tool_call: dict, user_request: str, store: EvidenceStore, cancel_event: threading.Event) -> tuple:
+        """返回(工具消息, 本次搜索得到的文档)."""
+        if cancel_event.is_set():
+            raise SpecialistCancelled()
+        documents = []
+        try:
+            documents = store.search(tool_call["args"].get("query", user_request))
+            content = store.render(documents) or "没有找到结果。"
+        except Exception as e:
+            content = f"error: 搜索失败: {e}"
+        return ToolMessage(content=content, tool_call_id=tool_call["id"], name=tool_call["name"]), documents
+
+    def run_specialist(user_request: str, store: EvidenceStore, cancel_event: threading.Event):
+        """有界的工具循环：执行请求的搜索并把结果反馈给模型，直到得到文本或达到上限。
+        每次模型调用和搜索之前检查取消事件，超时后尽快释放线程。"""
+        def check_cancelled():
+            if cancel_event.is_set():
+                raise SpecialistCancelled()
+
+        def shared_evidence() -> str:
+            # 专家是并行运行的，开始时证据池多半还是空的；每轮重新渲染，
+            # 兄弟专家在此期间获取的文档才能进入提示词（自己的搜索结果已在工具消息中，不重复）
+            others = [doc for doc in store.documents() if id(doc) not in seen]
+            return store.render(others) or "暂无。"
+
+        stats = {"llm_calls": 0, "tool_calls": 0, "iterations": 0, "tokens": 0, "hit_cap": False}
+        seen = set()
+        history = []
+        while True:
+            check_cancelled()
+            messages = prompt_template.format_messages(user_request=user_request, evidence=shared_evidence()) + history
+            result = llm_with_tools.invoke(messages)
+            stats["llm_calls"] += 1
+            stats["tokens"] += (getattr(result, "usage_metadata", None) or {}).get("total_tokens", 0)
+            if not result.tool_calls:
+                return result.content, stats
+            if stats["iterations"] >= MAX_TOOL_ITERATIONS or stats["tokens"] >= MAX_SPECIALIST_TOKENS:
+                break
+            stats["iterations"] += 1
+            stats["tool_calls"] += len(result.tool_calls)
+            # 本轮请求的所有搜索并发执行，结果按原顺序返回
+            tool_results = list(search_executor.map(lambda tc: run_tool_call(tc, user_request, store, cancel_event), result.tool_calls))
+            seen.update(id(doc) for _, documents in tool_results for doc in documents)
+            history = history + [result] + [message for message, _ in tool_results]
+
+        # 达到上限：不带工具再调用一次，强制模型基于已有结果写出报告
+        stats["hit_cap"] = True
+        check_cancelled()
+        messages = prompt_template.format_messages(user_request=user_request, evidence=shared_evidence()) + history
+        final = llm.invoke(messages + [HumanMessage(content="已达到搜索上限. 请仅基于以上已获取的信息写出你的报告部分.")])
+        stats["llm_calls"] += 1
+        stats["tokens"] += (getattr(final, "usage_metadata", None) or {}).get("total_tokens", 0)
+        return final.content, stats
 
     def specialist_node(state: MultiAgentState):
+        company = state.get("company")
+        cached = section_cache.get(company, output_key) if company else None
+        store = state["evidence_store"]
+        if cached is not None:
+            content, age, cited = cached
+            console.print(f"--- {output_key.replace('_report','').upper()} ANALYST: 使用缓存 ({age / 60:.0f} 分钟前) ---")
+            content = store.restore_citations(content, cited)
+            return {output_key: content, "specialist_stats": {output_key: {"cached": True, "age_seconds": round(age)}}}
         console.print(f"--- CALLING {output_key.replace('_report','').upper()} ANALYST ---")
-        result = agent.invoke({"user_request": state["user_request"]})
-        content = result.content if result.content else f"No direct content, tool calls: {result.tool_calls}"
-        return {output_key: content}
+        cancel_event = threading.Event()
+        future = specialist_executor.submit(run_specialist, state["user_request"], store, cancel_event)
+        try:
+            content, stats = future.result(timeout=SPECIALIST_TIMEOUT)
+        except FutureTimeoutError:
+            # 超时的专家不阻塞其余部分，报告撰写者会处理缺失的部分；
+            # 还没开始的直接取消，已经在运行的在下一次模型调用或搜索之前停止
+            cancel_event.set()
+            if not future.cancel():
+                future.add_done_callback(lambda _: specialist_log.info("%s 超时后已停止，释放线程池槽位", output_key))
+            specialist_log.warning("%s 超时 (%ss)，使用部分结果", output_key, SPECIALIST_TIMEOUT)
+            return {output_key: None, "failed_sections": [output_key]}
+        except Exception as e:
+            specialist_log.exception("%s 失败: %s", output_key, e)
+            return {output_key: None, "failed_sections": [output_key]}
+        specialist_log.info("%s 统计: %s", output_key, stats)
+        if company and content:
+            section_cache.put(company, output_key, content, store.cited_documents(content))
+        return {output_key: content, "specialist_stats": {output_key: stats}}
 
     return specialist_node
 
@@ -398,19 +690,27 @@ financial_analyst_node = create_specialist_node(
 def report_writer_node(state: MultiAgentState):
  """综合专家报告的管理者代理."""
  console.print("--- 调用报告撰写者 ---")
+ store = state["evidence_store"]
+ sources = store.sources()
+ missing = "该部分不可用（专家失败或超时）。"
+ failed = state.get("failed_sections") or []
+ note = f"\n 注意：以下部分不可用，请在报告中明确说明而不要编造内容：{', '.join(failed)}\n" if failed else ""
  prompt = f"""你是一个专业财务编辑. 你的任务是将以下专家报告合并为一个专业且连贯的市场分析报告. 添加简短的引言和结论段落.
- 
+ {note}
  News & Sentiment Report:
- {state['news_report']}
+ {state.get('news_report') or missing}
  
  Technical Analysis Report:
- {state['technical_report']}
+ {state.get('technical_report') or missing}
  
  Financial Performance Report:
- {state['financial_report']}
+ {state.get('financial_report') or missing}
+ 
+ Consolidated Sources（在报告末尾以编号列出引用的来源）:
+ {sources or "无"}
  """
- final_report = llm.invoke(prompt).content
- return {"final_report": final_report}
+ final_report, timing = stream_report(llm, prompt, "report_writer")
+ return {"final_report": final_report, "writer_timing": timing}
 
 print("专家代理节点和报告撰写者节点已定义.")
 
@@ -418,7 +718,7 @@ print("专家代理节点和报告撰写者节点已定义.")
 # ### 步骤2.2：构建多代理图
 # 
 # **我们将要做的:**
-# 现在我们将专家和管理者连接到图中. 对于这个任务, 专家可以独立工作, 所以我们可以按简单顺序运行它们 (在实际应用中, 这些可以并行运行). 最后一步总是报告撰写者.
+# 现在我们将专家和管理者连接到图中. 对于这个任务, 专家可以独立工作（每个只读取`user_request`）, 所以我们先由`prepare_evidence`节点为本次调用创建共享证据池, 再并行扇出三个专家, 最后扇入到报告撰写者. 报告撰写者会等待三个专家全部完成（或超时）后才运行.
 
 # In[6]:
 
@@ -426,16 +726,18 @@ print("专家代理节点和报告撰写者节点已定义.")
 multi_agent_graph_builder = StateGraph(MultiAgentState)
 
 # 添加所有节点
+multi_agent_graph_builder.add_node("prepare_evidence", prepare_evidence_node)
 multi_agent_graph_builder.add_node("news_analyst", news_analyst_node)
 multi_agent_graph_builder.add_node("technical_analyst", technical_analyst_node)
 multi_agent_graph_builder.add_node("financial_analyst", financial_analyst_node)
 multi_agent_graph_builder.add_node("report_writer", report_writer_node)
 
-# 定义工作流序列
-multi_agent_graph_builder.set_entry_point("news_analyst")
-multi_agent_graph_builder.add_edge("news_analyst", "technical_analyst")
-multi_agent_graph_builder.add_edge("technical_analyst", "financial_analyst")
-multi_agent_graph_builder.add_edge("financial_analyst", "report_writer")
+# 定义工作流：先创建证据池，再并行扇出专家，最后扇入报告撰写者
+multi_agent_graph_builder.add_edge(START, "prepare_evidence")
+specialist_nodes = ["news_analyst", "technical_analyst", "financial_analyst"]
+for node_name in specialist_nodes:
+    multi_agent_graph_builder.add_edge("prepare_evidence", node_name)
+multi_agent_graph_builder.add_edge(specialist_nodes, "report_writer")
 multi_agent_graph_builder.add_edge("report_writer", END)
 
 multi_agent_app = multi_agent_graph_builder.compile()
@@ -459,6 +761,7 @@ try:
     
     // 节点定义
     __start__ [shape=point];
+    prepare_evidence [label="prepare_evidence", style=filled, fillcolor="#f2f0ff"];
     news_analyst [label="news_analyst", style=filled, fillcolor="#f2f0ff"];
     technical_analyst [label="technical_analyst", style=filled, fillcolor="#f2f0ff"];
     financial_analyst [label="financial_analyst", style=filled, fillcolor="#f2f0ff"];
@@ -466,9 +769,12 @@ try:
     __end__ [label="__end__", shape=doublecircle, style=filled, fillcolor="#bfb6fc"];
     
     // 边定义
-    __start__ -> news_analyst;
-    news_analyst -> technical_analyst;
-    technical_analyst -> financial_analyst;
+    __start__ -> prepare_evidence;
+    prepare_evidence -> news_analyst;
+    prepare_evidence -> technical_analyst;
+    prepare_evidence -> financial_analyst;
+    news_analyst -> report_writer;
+    technical_analyst -> report_writer;
     financial_analyst -> report_writer;
     report_writer -> __end__;
 }
@@ -501,14 +807,42 @@ except Exception as e:
 
 
 multi_agent_query = f"为...创建简短但全面的市场分析报告 {company}."
-initial_multi_agent_input = {"user_request": multi_agent_query}
+initial_multi_agent_input = {"user_request": multi_agent_query, "company": company, "failed_sections": []}
 
-console.print(f"[bold green]测试 MULTI-AGENT TEAM in the same task:[/bold green] '{multi_agent_query}'")
+def stream_multi_agent_report(graph_input: dict, config: dict) -> dict:
+    """通过图的stream API运行：实时打印撰写者的令牌和小节事件，返回最终状态。"""
+    return stream_with_report_events(multi_agent_app, graph_input, config, writer_node="report_writer", console=console)
 
-final_multi_agent_output = multi_agent_app.invoke(initial_multi_agent_input)
+if not RUN_WATCHLIST_BATCH:
+    console.print(f"[bold green]测试 MULTI-AGENT TEAM in the same task:[/bold green] '{multi_agent_query}'")
+    multi_agent_start = time.perf_counter()
+    evidence_store = EvidenceStore()
+    final_multi_agent_output = stream_multi_agent_report(initial_multi_agent_input, {"configurable": {"evidence_store": evidence_store}})
+    multi_agent_log.info("证据池统计: %s, 去重后文档数: %d", evidence_store.stats, len(evidence_store.documents()))
+    multi_agent_log.info("专家工具循环统计: %s", final_multi_agent_output.get('specialist_stats'))
+    multi_agent_log.info("工具延迟统计: %s", tool_registry.latency_stats())
+    console.print(f"--- 多代理报告端到端耗时: {time.perf_counter() - multi_agent_start:.1f}s, 失败/超时部分: {final_multi_agent_output.get('failed_sections') or '无'} ---")
+
+    console.print("\n--- [bold green]Final Report from多代理 Team[/bold green] ---")
+    console.print(Markdown(final_multi_agent_output['final_report']))
+
+
+# ### 步骤3.1：增量刷新报告
+# 
+# 专家输出已经按(公司, 部分)持久化. 一段时间后再次运行同一公司的报告时, 只有过期的部分（通常是新闻）会重新运行, 报告撰写者再基于缓存和新鲜部分的组合重新撰写报告.
 
-console.print("\n--- [bold green]Final Report from多代理 Team[/bold green] ---")
-console.print(Markdown(final_multi_agent_output['final_report']))
+def refresh_report(company_name: str, stale_sections: Optional[List[str]] = None) -> dict:
+    """刷新一家公司的报告：强制刷新stale_sections，其余部分按TTL决定是否重跑。"""
+    for section in stale_sections or []:
+        section_cache.invalidate(company_name, section)
+    refresh_input = {"user_request": f"为...创建简短但全面的市场分析报告 {company_name}.", "company": company_name, "failed_sections": []}
+    return stream_multi_agent_report(refresh_input, {"configurable": {"evidence_store": EvidenceStore()}})
+
+if not RUN_WATCHLIST_BATCH:
+    # 模拟一小时后的刷新：新闻已过期，技术和财务部分仍在TTL内
+    refreshed_output = refresh_report(company, stale_sections=["news_report"])
+    rerun_sections = [key for key, stats in (refreshed_output.get("specialist_stats") or {}).items() if not stats.get("cached")]
+    console.print(f"\n--- 刷新完成：重新运行的部分 {rerun_sections}，其余部分来自缓存 ---")
 
 
 # **输出讨论:**
@@ -564,13 +898,14 @@ def evaluate_report(query: str, report: str):
  """
  return judge_llm.invoke(prompt)
 
-console.print("--- 评估单体代理的报告 ---")
-mono_agent_evaluation = evaluate_report(mono_query, final_mono_output['messages'][-1].content)
-console.print(mono_agent_evaluation.model_dump())
+if not RUN_WATCHLIST_BATCH:
+    console.print("--- 评估单体代理的报告 ---")
+    mono_agent_evaluation = evaluate_report(mono_query, final_mono_output['messages'][-1].content)
+    console.print(mono_agent_evaluation.model_dump())
 
-console.print("--- 评估多代理团队的报告 ---")
-multi_agent_evaluation = evaluate_report(multi_agent_query, final_multi_agent_output['final_report'])
-console.print(multi_agent_evaluation.model_dump())
+    console.print("--- 评估多代理团队的报告 ---")
+    multi_agent_evaluation = evaluate_report(multi_agent_query, final_multi_agent_output['final_report'])
+    console.print(multi_agent_evaluation.model_dump())
 
 
 # **输出讨论:**
@@ -578,6 +913,120 @@ console.print(multi_agent_evaluation.model_dump())
 # 
 # 这个评估证实，对于可以分解为专业领域的复杂任务, 多代理架构是生成高质量、结构化和可靠结果的优越方法.
 
+# ## 阶段5：观察列表批量模式
+# 
+# 交易台需要为数百个股票代码生成隔夜报告. 批量驱动程序在一个代码列表上运行同一个多代理图, 带有:
+# - **全局并发限制:** 同时运行的报告数量上限.
+# - **提供商速率限制:** 所有模型调用共享一个令牌桶限速器.
+# - **共享模型和搜索缓存:** 相同的提示和搜索在整个批次中只执行一次.
+# - **按代码重试:** 失败的代码以指数退避重试.
+# - **增量写入与断点续跑:** 每份完成的报告立即写入磁盘, 中断的批次重新运行时会跳过已完成的代码.
+# 
+# - **部分失败不算完成:** 有专家失败或超时的报告会重试（已成功的部分来自分节缓存, 只重跑失败的部分）, 重试耗尽仍不完整的代码记为失败, 下次运行会重新处理.
+# 
+# 运行方式: `RUN_WATCHLIST_BATCH=1 WATCHLIST_FILE=tickers.txt python 05_multi_agent.py`（文件每行一个代码）, 此时跳过前面各阶段的演示运行.
+
+# In[9]:
+
+
+from langchain_core.globals import set_llm_cache
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_community.cache import SQLiteCache
+
+def _write_report_atomically(path: str, content: str):
+    """先写临时文件再重命名，保证中断时不会留下半份报告。"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def _report_path(output_dir: str, ticker: str) -> str:
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in ticker)
+    return os.path.join(output_dir, f"{safe_name}.md")
+
+def run_ticker_report(ticker: str, search_cache: dict, max_retries: int = 2) -> dict:
+    """为单个代码运行多代理图，失败或有部分缺失时以指数退避重试。
+    专家节点捕获自己的异常并记入failed_sections，所以部分缺失同样视为失败；已成功的部分写入了分节缓存，重试只重跑缺失的部分。
+    search_cache 是批次内共享的搜索缓存（规范化查询 -> 原始搜索结果），位于每次运行的证据池之下。"""
+    query = f"为...创建简短但全面的市场分析报告 {ticker}."
+    last_error = None
+    for attempt in range(max_retries + 1):
+        try:
+            store = EvidenceStore(shared_cache=search_cache)
+            output = multi_agent_app.invoke({"user_request": query, "company": ticker, "failed_sections": []}, {"configurable": {"evidence_store": store}})
+            failed_sections = output.get("failed_sections") or []
+            if not failed_sections:
+                return {"ticker": ticker, "report": output["final_report"], "attempts": attempt + 1}
+            last_error = f"部分缺失: {', '.join(failed_sections)}"
+        except Exception as e:
+            last_error = e
+        if attempt == max_retries:
+            break
+        backoff = (2 ** attempt) + random.uniform(0, 1)
+        batch_log.warning("%s: 第 %d 次尝试失败 (%s)，%.1fs 后重试", ticker, attempt + 1, last_error, backoff)
+        time.sleep(backoff)
+    # 不完整的报告不写入磁盘、不记入清单，断点续跑时会重新处理这个代码
+    raise RuntimeError(f"{ticker} 在 {max_retries + 1} 次尝试后仍然失败: {last_error}")
+
+def run_watchlist_batch(tickers: List[str], output_dir: str = "watchlist_reports", max_concurrency: int = 4, requests_per_second: float = 2.0, max_retries: int = 2) -> dict:
+    """在观察列表上批量运行多代理图，已完成的报告会被跳过（断点续跑）。"""
+    os.makedirs(output_dir, exist_ok=True)
+
+    # 共享模型缓存：整个批次（以及之后的批次）中相同的提示只调用一次模型
+    set_llm_cache(SQLiteCache(database_path=os.path.join(output_dir, ".llm_cache.db")))
+    # 提供商速率限制：所有共享这个llm实例的节点都从同一个令牌桶取令牌
+    llm.rate_limiter = InMemoryRateLimiter(requests_per_second=requests_per_second, check_every_n_seconds=0.1, max_bucket_size=max(1, int(requests_per_second * 2)))
+
+    pending = [t for t in tickers if not os.path.exists(_report_path(output_dir, t))]
+    skipped = len(tickers) - len(pending)
+    if skipped:
+        batch_log.info("跳过 %d 个已完成的代码（断点续跑）", skipped)
+
+    # 搜索缓存只在本批次内有效，批次结束后随之释放，避免长驻进程中无限增长
+    search_cache = {}
+    manifest_path = os.path.join(output_dir, "manifest.jsonl")
+    completed, failed = [], []
+    batch_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="watchlist") as pool:
+        futures = {pool.submit(run_ticker_report, t, search_cache, max_retries): t for t in pending}
+        for future in as_completed(futures):
+            ticker = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                batch_log.error("%s: 放弃: %s", ticker, e)
+                failed.append(ticker)
+                continue
+            _write_report_atomically(_report_path(output_dir, ticker), result["report"])
+            with open(manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"ticker": ticker, "attempts": result["attempts"], "finished_at": time.time()}, ensure_ascii=False) + "\n")
+            completed.append(ticker)
+            elapsed_min = (time.perf_counter() - batch_start) / 60
+            batch_log.info("%d/%d 完成 (%s)，%.2f 代码/分钟", len(completed), len(pending), ticker, len(completed) / max(elapsed_min, 1e-9))
+
+    elapsed_min = (time.perf_counter() - batch_start) / 60
+    summary = {
+        "completed": len(completed),
+        "failed": failed,
+        "skipped": skipped,
+        "elapsed_minutes": round(elapsed_min, 2),
+        "tickers_per_minute": round(len(completed) / elapsed_min, 2) if elapsed_min > 0 else 0.0,
+    }
+    console.print(f"--- 批量模式完成: {summary} ---")
+    return summary
+
+if RUN_WATCHLIST_BATCH:
+    watchlist_file = os.environ["WATCHLIST_FILE"]
+    with open(watchlist_file, encoding="utf-8") as f:
+        watchlist = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    run_watchlist_batch(
+        watchlist,
+        output_dir=os.environ.get("WATCHLIST_OUTPUT_DIR", "watchlist_reports"),
+        max_concurrency=int(os.environ.get("WATCHLIST_CONCURRENCY", "4")),
+        requests_per_second=float(os.environ.get("PROVIDER_RPS", "2")),
+    )
+
+
 # ## 结论
 # 
 # 在这个notebook中，我们展示了**多代理系统**相对于单个单体代理在复杂、多方面任务上的明显优势。 通过创建专门代理团队，每个代理都有专注的人格和角色，以及一个管理者来综合他们的工作，我们产生了质量明显更高的最终输出。
@@ -72,7 +72,13 @@ from dotenv import load_dotenv
 
 
 import os 
-from typing import List, Annotated, TypedDict, Optional
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Annotated, TypedDict, Optional, NamedTuple, Callable, Literal
  
 from dotenv import load_dotenv
 
@@ -92,6 +98,9 @@ logger = logging.getLogger(__name__)
 from langchain_openai import ChatOpenAI
 
 from langchain_tavily import TavilySearch
+from tool_registry import tool_registry
+from agent_logging import get_logger, lazy
+from checkpointing import CheckpointStore, new_run_id
 from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage
  
 from pydantic import BaseModel, Field 
@@ -99,6 +108,8 @@ from langchain_core.prompts import ChatPromptTemplate
 
 # LangGraph components 
 from langgraph.graph import StateGraph, END
+from langgraph.errors import GraphRecursionError
+from report_streaming import stream_report, stream_with_report_events
 
 # 用于美观打印 
 from rich.console import Console
@@ -147,8 +158,8 @@ print("环境变量已加载，追踪设置已完成。")
 
 console = Console()
 # Using a more capable model to handle complex instructions better
-llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), temperature=0)
-search_tool = TavilySearch(max_results=2)
+llm = ChatOpenAI(model="Qwen/Qwen2.5-72B-Instruct", base_url=os.environ.get("OPENAI_API_BASE"), http_client=tool_registry.http_client(), temperature=0)
+search_tool = tool_registry.get("tavily_search", lambda: TavilySearch(max_results=2))
 
 # State for  sequential agent
 class SequentialState(TypedDict):
@@ -157,6 +168,8 @@ class SequentialState(TypedDict):
  technical_report: Optional[str]
  financial_report: Optional[str]
  final_report: Optional[str]
+ # 报告撰写者的首令牌时间和末令牌时间（秒）
+ writer_timing: Optional[dict]
 
 # --- CORRECTED SPECIALIST NODES FOR SEQUENTIAL AGENT ---
 # Key change is that each agent now gets context from previous steps, not just original request.
@@ -164,7 +177,7 @@ class SequentialState(TypedDict):
 def news_analyst_node_seq(state: SequentialState):
  console.print("--- (Sequential) 调用新闻分析师 ---")
  prompt = f"你的任务是作为专业新闻分析师。查找用户请求中主题的最新重大新闻并提供简洁摘要。\n\n用户请求: {state['user_request']}"
- agent = llm.bind_tools([search_tool])
+ agent = tool_registry.bind(llm, [search_tool])
  result = agent.invoke(prompt)
  return {"news_report": result.content}
 
@@ -172,7 +185,7 @@ def technical_analyst_node_seq(state: SequentialState):
  console.print("--- (Sequential) 调用技术分析师 ---")
  # This agent now uses news report as context.
  prompt = f"你的任务是作为专业技术分析师。基于以下新闻报告，对公司股票进行技术分析。\n\n新闻报告:\n{state['news_report']}"
- agent = llm.bind_tools([search_tool])
+ agent = tool_registry.bind(llm, [search_tool])
  result = agent.invoke(prompt)
  return {"technical_report": result.content}
 
@@ -180,7 +193,7 @@ def financial_analyst_node_seq(state: SequentialState):
  console.print("--- (Sequential) 调用财务分析师 ---")
  # This agent also uses news report as context.
  prompt = f"你的任务是作为专业财务分析师。基于以下新闻报告，分析公司最近的财务表现。\n\n新闻报告:\n{state['news_report']}"
- agent = llm.bind_tools([search_tool])
+ agent = tool_registry.bind(llm, [search_tool])
  result = agent.invoke(prompt)
  return {"financial_report": result.content}
 
@@ -199,8 +212,8 @@ def report_writer_node_seq(state: SequentialState):
 ---
 财务报告: {state['financial_report']}
 """
- report = llm.invoke(prompt).content
- return {"final_report": report}
+ report, timing = stream_report(llm, prompt, "writer")
+ return {"final_report": report, "writer_timing": timing}
 
 # Build sequential graph
 seq_graph_builder = StateGraph(SequentialState)
@@ -231,8 +244,8 @@ dynamic_query = "查找关于Nvidia的最新重大新闻。基于该新闻的情
 
 console.print(f"[bold yellow]测试修正的顺序代理在动态查询上:[/bold yellow]\n'{dynamic_query}'\n")
 
-# Run graph
-final_seq_output = sequential_app.invoke({"user_request": dynamic_query})
+# Run graph：通过stream API运行，撰写者的令牌和小节事件会实时显示
+final_seq_output = stream_with_report_events(sequential_app, {"user_request": dynamic_query}, writer_node="writer", console=console)
 
 console.print("\n--- [bold red]顺序代理的最终报告[/bold red] ---")
 console.print(Markdown(final_seq_output['final_report']))
@@ -255,24 +268,166 @@ console.print(Markdown(final_seq_output['final_report']))
 # In[5]:
 
 
+# 新闻情绪关键词，条目写入黑板时用于提取情绪字段
+SENTIMENT_KEYWORDS = {
+    "positive": ["积极", "正面", "利好", "乐观"],
+    "neutral": ["中性", "中立"],
+    "negative": ["负面", "消极", "利空", "悲观"],
+}
+
+def extract_sentiment(text: str) -> Optional[str]:
+    """从报告中提取情绪：优先看提到"情绪"的行，其次看全文；出现多种或都没有时返回None（模糊）。"""
+    def classify(fragment: str) -> Optional[str]:
+        found = {label for label, words in SENTIMENT_KEYWORDS.items() if any(w in fragment for w in words)}
+        return found.pop() if len(found) == 1 else None
+    sentiment_lines = [line for line in text.splitlines() if "情绪" in line or "sentiment" in line.lower()]
+    for line in sentiment_lines:
+        label = classify(line)
+        if label:
+            return label
+    return classify(text)
+
+# 黑板条目：结构化字段在写入时提取一次，控制器和专家不再对原始字符串做子串扫描
+class BlackboardEntry(TypedDict):
+ agent: str
+ timestamp: float
+ # 'news'、'analysis'、'final_report'或'error'
+ kind: str
+ # 新闻条目的情绪：'positive'、'neutral'、'negative'，模糊时为None
+ sentiment: Optional[str]
+ body: str
+ # 写入时生成的紧凑摘要（要点、情绪、来源）和正文中引用的链接
+ digest: str
+ sources: List[str]
+ # 写入条目的控制器周期（超步），同一周期内并行运行的专家共享同一个值
+ cycle: int
+
+AGENT_KINDS = {"新闻分析师": "news", "技术分析师": "analysis", "财务分析师": "analysis", "报告撰写者": "final_report"}
+# 同一超步内并行专家条目的固定顺序
+AGENT_ORDER = {name: i for i, name in enumerate(AGENT_KINDS)}
+
+def _entry_order(entry: BlackboardEntry) -> tuple:
+    return (entry["cycle"], AGENT_ORDER.get(entry["agent"], len(AGENT_ORDER)), entry["agent"])
+
+def _append_in_order(bucket: List[BlackboardEntry], new_entries: List[BlackboardEntry]) -> List[BlackboardEntry]:
+    """追加新条目，并把末尾同一周期的条目按固定顺序排列，使并行专家的合并结果与完成先后无关。"""
+    merged = bucket + new_entries
+    if not new_entries:
+        return merged
+    cycle = min(entry["cycle"] for entry in new_entries)
+    start = len(bucket)
+    while start > 0 and merged[start - 1]["cycle"] >= cycle:
+        start -= 1
+    merged[start:] = sorted(merged[start:], key=_entry_order)
+    return merged
+
+def post_entries(blackboard: List[BlackboardEntry], new_entries: List[BlackboardEntry]) -> List[BlackboardEntry]:
+    """只追加的黑板归约器：节点只返回新条目。"""
+    return _append_in_order(blackboard, new_entries)
+
+def index_entries(index: dict, new_entries: List[BlackboardEntry]) -> dict:
+    """维护按代理和按类型的索引，只复制被新条目触及的桶。"""
+    by_agent = dict(index.get("by_agent", {}))
+    by_kind = dict(index.get("by_kind", {}))
+    for entry in new_entries:
+        by_agent[entry["agent"]] = _append_in_order(by_agent.get(entry["agent"], []), [entry])
+        by_kind[entry["kind"]] = _append_in_order(by_kind.get(entry["kind"], []), [entry])
+    return {"by_agent": by_agent, "by_kind": by_kind}
+
+# --- 条目摘要 ---
+# 控制器的提示和专家的上下文原本都嵌入整个黑板，提示令牌随每份报告、每个周期增长。
+# 每个条目在写入时生成一次紧凑摘要：控制器只看摘要，专家只看与自己相关条目的全文，其余条目只看摘要。
+URL_PATTERN = re.compile(r"https?://[^\s)\]>\"']+")
+BULLET_PATTERN = re.compile(r"^\s*(?:[-*•]|\d+[.、)])\s*")
+DIGEST_MAX_FINDINGS = 3
+DIGEST_FINDING_CHARS = 120
+SENTIMENT_LABELS = {"positive": "积极", "neutral": "中性", "negative": "负面"}
+
+def make_digest(body: str, sentiment: Optional[str], sources: List[str]) -> str:
+    """抽取式摘要：取前几条要点（列表项优先，否则取开头的段落），附上情绪和来源数量。"""
+    lines = [line.strip() for line in body.splitlines() if line.strip() and not line.strip().startswith("#")]
+    bullets = [BULLET_PATTERN.sub("", line) for line in lines if BULLET_PATTERN.match(line)]
+    findings = (bullets or lines)[:DIGEST_MAX_FINDINGS]
+    findings = [f[:DIGEST_FINDING_CHARS] + ("…" if len(f) > DIGEST_FINDING_CHARS else "") for f in findings]
+    parts = ["要点: " + "；".join(findings) if findings else "要点: （无）"]
+    if sentiment:
+        parts.append(f"情绪: {SENTIMENT_LABELS[sentiment]}")
+    parts.append(f"来源: {len(sources)} 个")
+    return " | ".join(parts)
+
+def make_entry(agent_name: str, body: str, kind: Optional[str] = None, cycle: int = 0) -> BlackboardEntry:
+    kind = kind or AGENT_KINDS.get(agent_name, "analysis")
+    sentiment = extract_sentiment(body) if kind == "news" else None
+    sources = list(dict.fromkeys(URL_PATTERN.findall(body)))
+    return {"agent": agent_name, "timestamp": time.time(), "kind": kind, "sentiment": sentiment, "body": body,
+            "digest": make_digest(body, sentiment, sources), "sources": sources, "cycle": cycle}
+
+def post(entry: BlackboardEntry) -> dict:
+    """节点返回的状态更新：同一条目同时写入黑板和索引。"""
+    return {"blackboard": [entry], "blackboard_index": [entry]}
+
+def render_entry(entry: BlackboardEntry) -> str:
+    return f"**报告来自{entry['agent']}:**\n{entry['body']}"
+
+def render_digest(entry: BlackboardEntry) -> str:
+    return f"**报告来自{entry['agent']}:** （摘要）{entry['digest']}"
+
+# 每个专家需要全文的条目类型；其他条目只提供摘要
+SPECIALIST_CONTEXT_KINDS = {
+    "新闻分析师": set(),
+    "技术分析师": {"news"},
+    "财务分析师": {"news"},
+    "报告撰写者": {"news", "analysis"},
+}
+
+def specialist_context(blackboard: List[BlackboardEntry], agent_name: str) -> str:
+    """专家的黑板上下文：相关条目给全文，其余条目给摘要。"""
+    full_kinds = SPECIALIST_CONTEXT_KINDS.get(agent_name, set())
+    return "\n---\n".join(render_entry(entry) if entry["kind"] in full_kinds else render_digest(entry) for entry in blackboard)
+
+def latest_entry(index: dict, agent: Optional[str] = None, kind: Optional[str] = None) -> Optional[BlackboardEntry]:
+    """O(1)查找某个代理或某种类型的最新条目。"""
+    bucket = index.get("by_agent", {}).get(agent) if agent else index.get("by_kind", {}).get(kind)
+    return bucket[-1] if bucket else None
+
 # Blackboard State holds all infor mation
 class BlackboardState(TypedDict):
  user_request: str
- # Central blackboard where agents post their findings as strings
- blackboard: List[str]
+ # Central blackboard where agents post their findings (append-only)
+ blackboard: Annotated[List[BlackboardEntry], post_entries]
+ # 按代理和类型的索引：{"by_agent": {代理: [条目]}, "by_kind": {类型: [条目]}}
+ blackboard_index: Annotated[dict, index_entries]
  # List of available agents for controller to choose from
  available_agents: List[str]
  # Controller's next decision
  next_agent: Optional[str]
+ # 本超步要并行运行的全部代理（包含next_agent），或['FINISH']
+ next_agents: List[str]
+ # 控制器周期计数
+ cycle: int
+ # 每个代理被选中的次数，用于检测重复选择
+ selection_counts: Optional[dict]
+ # 运行开始时间（time.time()），用于时间预算
+ started_at: Optional[float]
+ # 运行结束的原因：'completed'、'repeated_selection'、'cycle_budget_exhausted'、'time_budget_exhausted'等
+ termination_reason: Optional[str]
 
 # Pydantic model for  Controller's decision
 # CORRECTION: Added list of available agents to field description to guide LLM's choice.
 class ControllerDecision(BaseModel):
  next_agent: str = Field(description="要调用的下一个代理的名称。必须是['新闻分析师', '技术分析师', '财务分析师', '报告撰写者']之一或'FINISH'。")
+ also_run: List[str] = Field(default_factory=list, description="在当前黑板下与next_agent互不依赖、可以同时并行运行的其他代理；没有则为空列表。")
  reasoning: str = Field(description="选择下一个代理的简要原因。")
 
+# 分组件的日志：默认只写INFO及以上到文件，AGENT_LOG_LEVELS=blackboard.controller=DEBUG 可单独打开某个组件的调试输出
+specialist_log = get_logger("blackboard.specialist")
+controller_log = get_logger("blackboard.controller")
+
 # Reusable factory for  creating specialist agents for  blackboard
-def create_blackboard_specialist(persona: str, agent_name: str):
+# 每个专家的耗时统计（秒）：调用次数、总耗时、模型耗时、工具耗时
+specialist_timings = {}
+
+def create_blackboard_specialist(persona: str, agent_name: str, tools: Optional[list] = None):
     system_prompt = f"""你是一名专业的专家代理：{persona}.
 你的任务是通过执行你的特定功能来为更大的目标做贡献。
 阅读初始用户请求和当前黑板以获取上下文。
@@ -283,77 +438,86 @@ def create_blackboard_specialist(persona: str, agent_name: str):
         ("system", system_prompt),
         ("human", "用户请求: {user_request}\n\n黑板（之前的报告）:\n{blackboard_str}")
     ])
-    
-    # 创建一个带工具调用的LLM链
-    def agent_chain(inputs):
+    # 第二步的提示同样只构造一次；模型的中间回复作为变量传入，其中的花括号不会被当作模板变量
+    final_prompt = ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        ("human", "用户请求: {user_request}\n\n黑板（之前的报告）:\n{blackboard_str}"),
+        ("ai", "{ai_content}"),
+        ("human", "工具结果: {tool_results}")
+    ])
+
+    # 链在构造时编译一次，工具调用按名字通过分派表路由到绑定的工具
+    tools = tools or [search_tool]
+    tool_dispatch = {tool.name: tool for tool in tools}
+    tool_chain = prompt_template | tool_registry.bind(llm, tools)
+    report_chain = final_prompt | llm
+    timing = specialist_timings.setdefault(agent_name, {"calls": 0, "total": 0.0, "llm": 0.0, "tools": 0.0, "tool_calls": 0, "unknown_tools": 0})
+
+    def run_tool_call(tool_call) -> str:
+        tool = tool_dispatch.get(tool_call["name"])
+        if tool is None:
+            timing["unknown_tools"] += 1
+            specialist_log.warning("%s 请求了未绑定的工具 '%s'", agent_name, tool_call["name"])
+            return f"错误: 工具 '{tool_call['name']}' 不可用，可用工具: {list(tool_dispatch)}"
         try:
-            # 第一步：获取工具调用请求
-            result = (prompt_template | llm.bind_tools([search_tool])).invoke(inputs)
-            
-            # 如果有工具调用，执行工具
-            if hasattr(result, 'tool_calls') and result.tool_calls:
-                console.print(f"[DEBUG] 执行工具调用: {result.tool_calls}")
-                
-                # 收集工具调用结果
-                tool_results = []
-                for tool_call in result.tool_calls:
-                    if tool_call["name"] == "tavily_search":
-                        # 执行Tavily搜索
-                        search_result = search_tool.invoke(tool_call["args"])
-                        tool_results.append({
-                            "tool_call": tool_call,
-                            "result": search_result
-                        })
-                
-                # 第二步：将工具结果返回给LLM，生成最终报告
-                final_prompt = ChatPromptTemplate.from_messages([
-                    ("system", system_prompt),
-                    ("human", "用户请求: {user_request}\n\n黑板（之前的报告）:\n{blackboard_str}"),
-                    ("ai", result.content if hasattr(result, 'content') else ""),
-                    ("human", "工具结果: {tool_results}")
-                ])
-                
-                # 将工具结果格式化为字符串
-                tool_results_str = "\n\n".join([
-                    f"工具: {tr['tool_call']['name']}\n参数: {tr['tool_call']['args']}\n结果: {tr['result']}"
-                    for tr in tool_results
-                ])
-                
-                # 生成最终报告
-                final_result = final_prompt | llm
-                report_content = final_result.invoke({
-                    "user_request": inputs["user_request"],
-                    "blackboard_str": inputs["blackboard_str"],
-                    "tool_results": tool_results_str
-                })
-                
-                return report_content.content if hasattr(report_content, 'content') else str(report_content)
-            else:
-                # 没有工具调用，直接返回结果
-                return result.content if hasattr(result, 'content') else "没有获取到有效内容"
+            return tool.invoke(tool_call["args"])
         except Exception as e:
-            console.print(f"[ERROR] 专家代理执行过程中出错: {e}")
-            # 使用默认值作为降级策略
-            return f"{agent_name}执行过程中出现错误: {str(e)}"
+            specialist_log.warning("%s 调用工具 '%s' 失败: %s", agent_name, tool_call["name"], e)
+            return f"错误: 工具 '{tool_call['name']}' 调用失败: {e}"
+
+    def agent_chain(inputs):
+        # 第一步：获取工具调用请求
+        llm_start = time.perf_counter()
+        result = tool_chain.invoke(inputs)
+        timing["llm"] += time.perf_counter() - llm_start
+        
+        # 如果有工具调用，执行工具
+        if not getattr(result, "tool_calls", None):
+            # 没有工具调用，直接返回结果
+            return result.content or "没有获取到有效内容"
+        specialist_log.debug("%s 执行工具调用: %s", agent_name, result.tool_calls)
+
+        tool_start = time.perf_counter()
+        tool_results_str = "\n\n".join(
+            f"工具: {tool_call['name']}\n参数: {tool_call['args']}\n结果: {run_tool_call(tool_call)}"
+            for tool_call in result.tool_calls
+        )
+        timing["tools"] += time.perf_counter() - tool_start
+        timing["tool_calls"] += len(result.tool_calls)
+
+        # 第二步：将工具结果返回给LLM，生成最终报告
+        llm_start = time.perf_counter()
+        report_content = report_chain.invoke({
+            "user_request": inputs["user_request"],
+            "blackboard_str": inputs["blackboard_str"],
+            "ai_content": result.content or "",
+            "tool_results": tool_results_str
+        })
+        timing["llm"] += time.perf_counter() - llm_start
+        return report_content.content
 
     def specialist_node(state: BlackboardState):
         console.print(f"--- (黑板) 代理 '{agent_name}' 正在工作... ---")
-        blackboard_str = "\n---\n".join(state["blackboard"])
+        blackboard_str = specialist_context(state["blackboard"], agent_name)
         
         # 执行代理链，获取报告内容
-        report_content = agent_chain({
-            "user_request": state["user_request"], 
-            "blackboard_str": blackboard_str
-        })
+        node_start = time.perf_counter()
+        try:
+            entry = make_entry(agent_name, agent_chain({
+                "user_request": state["user_request"], 
+                "blackboard_str": blackboard_str
+            }), cycle=state.get("cycle", 0))
+        except Exception as e:
+            specialist_log.exception("%s 执行过程中出错: %s", agent_name, e)
+            # 使用默认值作为降级策略
+            entry = make_entry(agent_name, f"{agent_name}执行过程中出现错误: {str(e)}", kind="error", cycle=state.get("cycle", 0))
+        timing["calls"] += 1
+        timing["total"] += time.perf_counter() - node_start
         
-        report = f"**报告来自{agent_name}:**\n{report_content}"
-        # Debug: 检查完整报告内容
-        console.print(f"[DEBUG] 完整报告内容: {report}")
-        console.print(f"[DEBUG] 报告长度: {len(report)} 字符")
-        # Append new report to list of blackboard entries
-        new_blackboard = state["blackboard"] + [report]
-        console.print(f"[DEBUG] 黑板更新前长度: {len(state['blackboard'])}, 更新后长度: {len(new_blackboard)}")
-        return {"blackboard": new_blackboard}
+        specialist_log.info("%s 发布条目: 长度=%d 类型=%s 情绪=%s", agent_name, len(entry['body']), entry['kind'], entry['sentiment'])
+        specialist_log.debug("完整报告内容: %s", lazy(lambda: render_entry(entry)))
+        # 只返回新条目，由归约器追加到黑板并更新索引
+        return post(entry)
     return specialist_node
 
 # Create specialist agent nodes
@@ -362,31 +526,238 @@ technical_analyst_bb = create_blackboard_specialist("技术分析师", "技术
 financial_analyst_bb = create_blackboard_specialist("财务分析师", "财务分析师")
 report_writer_bb = create_blackboard_specialist("从黑板综合最终答案的报告撰写者", "报告撰写者")
 
-# --- THE CORRECTED, INTELLIGENT CONTROLLER NODE ---
-# This is the most important fix. The prompt is now much more sophisticated.
+# --- 控制器的规则快速路径 ---
+# 控制器的大多数决策是机械的：先新闻，再根据情绪选择技术或财务分析，然后撰写报告，最后FINISH。
+# 声明式规则先在黑板的索引视图上求值，只有真正模糊的情况（例如新闻情绪不明确）才调用模型。
+def build_blackboard_view(state: BlackboardState) -> dict:
+    """控制器规则需要的视图：已报告的代理（来自索引）和最新新闻条目在写入时提取的情绪。"""
+    index = state.get("blackboard_index") or {}
+    news = latest_entry(index, agent="新闻分析师")
+    return {"reports": index.get("by_agent", {}), "news_sentiment": news["sentiment"] if news else None,
+            "conditional": is_sentiment_conditional(state["user_request"])}
+
+def is_sentiment_conditional(user_request: str) -> bool:
+    """请求是否要求根据新闻情绪二选一地安排分析；否则技术和财务分析互不依赖，可以并行。"""
+    return "情绪" in user_request and any(word in user_request for word in ("如果", "要么", "或者", "取决于"))
+
+class ControllerRule(NamedTuple):
+    name: str
+    condition: Callable[[dict], bool]
+    next_agents: tuple
+
+# 按顺序求值，第一条满足条件的规则给出决策；没有规则匹配时交给模型
+CONTROLLER_RULES = [
+    ControllerRule("撰写者已完成", lambda v: "报告撰写者" in v["reports"], ("FINISH",)),
+    ControllerRule("分析已完成", lambda v: "技术分析师" in v["reports"] or "财务分析师" in v["reports"], ("报告撰写者",)),
+    ControllerRule("分析互不依赖", lambda v: "新闻分析师" in v["reports"] and not v["conditional"], ("技术分析师", "财务分析师")),
+    ControllerRule("新闻积极或中性", lambda v: "新闻分析师" in v["reports"] and v["news_sentiment"] in ("positive", "neutral"), ("技术分析师",)),
+    ControllerRule("新闻负面", lambda v: "新闻分析师" in v["reports"] and v["news_sentiment"] == "negative", ("财务分析师",)),
+    ControllerRule("黑板为空", lambda v: not v["reports"], ("新闻分析师",)),
+]
+controller_stats = {"rule_decided": 0, "llm_decided": 0, "sentiment_cache_hits": 0, "sentiment_llm_calls": 0, "revalidations": 0, "revalidation_disagreements": 0,
+                    "cycles": 0, "parallel_supersteps": 0, "repeated_selections": 0, "forced_writer": 0}
+
+def apply_controller_rules(view: dict, available_agents: List[str]) -> Optional[ControllerRule]:
+    for rule in CONTROLLER_RULES:
+        if rule.condition(view):
+            # 规则选中的代理不在可用列表中时，交给模型处理
+            return rule if rule.next_agents == ("FINISH",) or all(a in available_agents for a in rule.next_agents) else None
+    return None
+
+def select_agents(agents: List[str], available_agents: List[str]) -> List[str]:
+    """规范化一次超步的代理选择：去重、过滤不可用代理、按固定顺序排列。
+    报告撰写者依赖其他代理的输出，不与它们并行；FINISH优先于一切。"""
+    if "FINISH" in agents:
+        return ["FINISH"]
+    selected = sorted({a for a in agents if a in available_agents}, key=lambda a: AGENT_ORDER.get(a, len(AGENT_ORDER)))
+    if "报告撰写者" in selected and len(selected) > 1:
+        selected.remove("报告撰写者")
+    return selected or ["FINISH"]
+
+# --- 新闻情绪分类缓存 ---
+# 规则已经覆盖了情绪被提取出来的所有局面，控制器需要模型的几乎只剩"新闻情绪模糊"这一种情况，
+# 而模型真正要回答的只是"这份新闻是积极、中性还是负面"。这里只让模型做这个分类，结果交回给规则决定调用谁。
+# 分类按粗粒度指纹缓存（请求模板 + 新闻中各类情绪关键词的命中次数分桶 + 是否有情绪行），不依赖新闻全文，
+# 同类请求的多次运行可以复用；同一指纹的分类足够一致时才复用，并每隔若干次命中让模型重新分类一次，检验缓存是否仍然成立。
+SENTIMENT_CACHE_MIN_CONFIDENCE = float(os.environ.get("SENTIMENT_CACHE_MIN_CONFIDENCE", "0.8"))
+SENTIMENT_CACHE_MIN_OBSERVATIONS = 2
+SENTIMENT_CACHE_REVALIDATE_EVERY = int(os.environ.get("SENTIMENT_CACHE_REVALIDATE_EVERY", "10"))
+
+class NewsSentiment(BaseModel):
+ sentiment: Literal["positive", "neutral", "negative"] = Field(description="新闻报告整体的情绪。")
+
+def request_template(user_request: str) -> str:
+    """请求模板：数字和英文名称（公司名、股票代码）替换为占位符，使同一类请求共享指纹。"""
+    template = re.sub(r"\d+(?:\.\d+)?", "<数>", user_request)
+    template = re.sub(r"[A-Za-z][A-Za-z0-9&.\-]*", "<名>", template)
+    return re.sub(r"\s+", " ", template).strip()
+
+def sentiment_fingerprint(user_request: str, body: str) -> str:
+    """情绪分类的指纹：请求模板和新闻的粗粒度特征（每类关键词命中次数，封顶为3），与全文的具体措辞无关。"""
+    keyword_hits = {label: min(3, sum(body.count(w) for w in words)) for label, words in SENTIMENT_KEYWORDS.items()}
+    has_sentiment_line = any("情绪" in line or "sentiment" in line.lower() for line in body.splitlines())
+    key = [request_template(user_request), sorted(keyword_hits.items()), has_sentiment_line]
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class SentimentCache:
+    """基于SQLite的新闻情绪分类缓存，线程安全。每个指纹保存模型给出各个情绪标签的次数。"""
+
+    def __init__(self, path: str = "news_sentiment_cache.db"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sentiments (fingerprint TEXT PRIMARY KEY, counts TEXT, hits INTEGER, updated_at REAL)")
+        self._conn.commit()
+
+    def lookup(self, fingerprint: str) -> Optional[tuple]:
+        """返回(情绪标签, 置信度, 是否需要重新验证)；观察不足或置信度低于阈值时返回None。"""
+        with self._lock:
+            row = self._conn.execute("SELECT counts, hits FROM sentiments WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            if row is None:
+                return None
+            counts = json.loads(row[0])
+            observations = sum(counts.values())
+            label, support = max(counts.items(), key=lambda item: item[1])
+            confidence = support / observations
+            if observations < SENTIMENT_CACHE_MIN_OBSERVATIONS or confidence < SENTIMENT_CACHE_MIN_CONFIDENCE:
+                return None
+            hits = row[1] + 1
+            self._conn.execute("UPDATE sentiments SET hits = ? WHERE fingerprint = ?", (hits, fingerprint))
+            self._conn.commit()
+        return label, confidence, hits % SENTIMENT_CACHE_REVALIDATE_EVERY == 0
+
+    def record(self, fingerprint: str, label: str):
+        """记录一次模型分类。"""
+        with self._lock:
+            row = self._conn.execute("SELECT counts, hits FROM sentiments WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            counts, hits = (json.loads(row[0]), row[1]) if row else ({}, 0)
+            counts[label] = counts.get(label, 0) + 1
+            self._conn.execute("INSERT OR REPLACE INTO sentiments VALUES (?, ?, ?, ?)", (fingerprint, json.dumps(counts), hits, time.time()))
+            self._conn.commit()
+
+sentiment_cache = SentimentCache(os.environ.get("SENTIMENT_CACHE_PATH", "news_sentiment_cache.db"))
+
+def classify_news_sentiment(state: BlackboardState, news: BlackboardEntry) -> Optional[str]:
+    """为情绪模糊的新闻条目给出情绪标签：先查缓存，未命中（或到了重新验证的时候）再让模型分类；模型失败时返回None。"""
+    fingerprint = sentiment_fingerprint(state["user_request"], news["body"])
+    cached = sentiment_cache.lookup(fingerprint)
+    if cached is not None and not cached[2]:
+        controller_stats["sentiment_cache_hits"] += 1
+        console.print(f"--- 控制器: 情绪缓存命中（{cached[0]}，置信度 {cached[1]:.2f}） ---")
+        return cached[0]
+    controller_stats["sentiment_llm_calls"] += 1
+    prompt = f"判断下面这份新闻报告对用户请求所涉及公司的整体情绪（positive、neutral或negative）。\n\n**用户请求：**\n{state['user_request']}\n\n**新闻报告：**\n{news['body']}"
+    try:
+        label = llm.with_structured_output(NewsSentiment).invoke(prompt).sentiment
+    except Exception as e:
+        controller_log.warning("新闻情绪分类失败，交给控制器模型决策: %s", e)
+        return cached[0] if cached is not None else None
+    sentiment_cache.record(fingerprint, label)
+    if cached is not None:
+        # 定期重新验证：比较模型的新分类和缓存的分类
+        controller_stats["revalidations"] += 1
+        if label != cached[0]:
+            controller_stats["revalidation_disagreements"] += 1
+            controller_log.warning("情绪缓存重新验证不一致: 缓存=%s 模型=%s", cached[0], label)
+    return label
+
+def model_decision(state: BlackboardState) -> List[str]:
+    """调用模型决策，返回规范化的代理列表。"""
+    decision = llm_controller_decision(state)
+    return select_agents([decision["next_agent"]] + decision.get("also_run", []), state['available_agents'])
+
+# --- 周期和成本预算 ---
+# 控制器循环时，图原本会一直运行到recursion_limit并抛出GraphRecursionError，已完成的工作全部丢失。
+# 预算在控制器内部执行：过滤重复选择，预算将尽时强制调用报告撰写者，预算耗尽时以FINISH正常结束并记录原因。
+BLACKBOARD_MAX_CYCLES = int(os.environ.get("BLACKBOARD_MAX_CYCLES", "6"))
+BLACKBOARD_MAX_SECONDS = float(os.environ.get("BLACKBOARD_MAX_SECONDS", "300"))
+MAX_SELECTIONS_PER_AGENT = 2
+
+def enforce_budget(state: BlackboardState, view: dict, agents: List[str]) -> tuple:
+    """根据预算修正控制器的选择，返回(代理列表, 提前结束或强制撰写的原因)。"""
+    if agents == ["FINISH"]:
+        return agents, None
+    cycle = state.get("cycle", 0) + 1
+    elapsed = time.time() - (state.get("started_at") or time.time())
+    writer_done = "报告撰写者" in view["reports"]
+    if cycle > BLACKBOARD_MAX_CYCLES or elapsed > BLACKBOARD_MAX_SECONDS:
+        reason = "cycle_budget_exhausted" if cycle > BLACKBOARD_MAX_CYCLES else "time_budget_exhausted"
+        controller_log.warning("预算耗尽 (%s): 周期=%d 耗时=%.1fs", reason, cycle, elapsed)
+        return ["FINISH"], reason
+
+    # 重复选择：已经成功报告过的代理，或被选中次数达到上限的代理
+    counts = state.get("selection_counts") or {}
+    def is_repeat(agent: str) -> bool:
+        succeeded = any(entry["kind"] != "error" for entry in view["reports"].get(agent, []))
+        return succeeded or counts.get(agent, 0) >= MAX_SELECTIONS_PER_AGENT
+    fresh = [agent for agent in agents if not is_repeat(agent)]
+    reason = None
+    if len(fresh) < len(agents):
+        controller_stats["repeated_selections"] += 1
+        controller_log.warning("检测到重复选择: %s", [a for a in agents if a not in fresh])
+        reason = "repeated_selection"
+
+    # 只剩最后一个周期时，把它留给报告撰写者
+    if not writer_done and cycle >= BLACKBOARD_MAX_CYCLES and fresh != ["报告撰写者"]:
+        controller_stats["forced_writer"] += 1
+        console.print("--- 控制器: 预算将尽，强制调用 '报告撰写者' ---")
+        return (["报告撰写者"], None) if not is_repeat("报告撰写者") else (["FINISH"], "cycle_budget_exhausted")
+    if not fresh:
+        # 所选代理都在重复：有分析结果时撰写报告，否则结束
+        if not writer_done and not is_repeat("报告撰写者") and len(view["reports"]) > 0:
+            controller_stats["forced_writer"] += 1
+            return ["报告撰写者"], None
+        return ["FINISH"], reason
+    return fresh, None
+
 def controller_node(state: BlackboardState):
     console.print("--- 控制器: 分析黑板中... ---")
+    controller_stats["cycles"] += 1
+    view = build_blackboard_view(state)
+    rule = apply_controller_rules(view, state['available_agents'])
+    news = latest_entry(state.get("blackboard_index") or {}, agent="新闻分析师")
+    if rule is None and news is not None and view["news_sentiment"] is None:
+        # 规则因为新闻情绪模糊而无法决策：只让模型（或缓存）给出情绪，再交回规则
+        view["news_sentiment"] = classify_news_sentiment(state, news)
+        rule = apply_controller_rules(view, state['available_agents'])
+    if rule is not None:
+        controller_stats["rule_decided"] += 1
+        agents = select_agents(list(rule.next_agents), state['available_agents'])
+        console.print(f"--- 控制器: 规则 '{rule.name}' 决定调用 {agents} ---")
+    else:
+        controller_stats["llm_decided"] += 1
+        console.print(f"--- 控制器: 没有规则匹配（新闻情绪: {view['news_sentiment']}），交给模型决策 ---")
+        agents = model_decision(state)
+    agents, reason = enforce_budget(state, view, agents)
+    if len(agents) > 1:
+        controller_stats["parallel_supersteps"] += 1
+    counts = dict(state.get("selection_counts") or {})
+    for agent in agents:
+        if agent != "FINISH":
+            counts[agent] = counts.get(agent, 0) + 1
+    update = {"next_agent": agents[0], "next_agents": agents, "cycle": state.get("cycle", 0) + 1,
+              "selection_counts": counts, "started_at": state.get("started_at") or time.time()}
+    if agents == ["FINISH"]:
+        update["termination_reason"] = reason or "completed"
+        console.print(f"--- 控制器: 运行结束，原因: {update['termination_reason']} ---")
+    return update
 
-    blackboard_content = "\n\n".join(state['blackboard'])
+# --- THE CORRECTED, INTELLIGENT CONTROLLER NODE ---
+# This is the most important fix. The prompt is now much more sophisticated.
+def llm_controller_decision(state: BlackboardState):
+
+    # 控制器只看摘要；需要全文时通过索引按代理取出
+    blackboard_content = "\n\n".join(render_digest(entry) for entry in state['blackboard'])
     agent_list = state['available_agents']
+    index = state.get('blackboard_index') or {}
+    news = latest_entry(index, agent="新闻分析师")
+    if news and news['sentiment'] is None and "技术分析师" not in index.get("by_agent", {}) and "财务分析师" not in index.get("by_agent", {}):
+        # 规则无法从摘要判断新闻情绪，这正是模型需要读全文的情况
+        blackboard_content += "\n\n**新闻报告全文（情绪需要你判断）：**\n" + news['body']
 
     # 添加详细调试信息，显示黑板的原始内容
-    console.print(f"[DEBUG] 黑板条目数量: {len(state['blackboard'])}")
-    for i, entry in enumerate(state['blackboard']):
-        console.print(f"[DEBUG] 黑板条目 {i} 原始内容:\n{repr(entry)}")
-        console.print(f"[DEBUG] 黑板条目 {i} 前50字符: {entry[:50]}")
-    console.print(f"[DEBUG] 控制器接收到的黑板内容:\n{blackboard_content}")
-    
-    # 检查是否包含情绪分析信息
-    has_sentiment = False
-    sentiment_keywords = ['积极', '中性', '负面', '情绪分析']
-    for i, entry in enumerate(state['blackboard']):
-        if any(keyword in entry for keyword in sentiment_keywords):
-            has_sentiment = True
-            console.print(f"[DEBUG] 在黑板条目 {i} 中检测到情绪分析信息")
-            break
-    if not has_sentiment:
-        console.print(f"[DEBUG] 未在黑板内容中检测到情绪分析信息")
+    controller_log.debug("黑板条目数量: %d, 新闻情绪: %s", len(state['blackboard']), news['sentiment'] if news else '无新闻报告')
+    # 内容已经构建好（提示词需要它），直接作为%参数传入，级别未启用时不会被格式化
+    controller_log.debug("控制器接收到的黑板内容:\n%s", blackboard_content)
 
     # New prompt is state-aware and goal-oriented.
     # 构建基本提示，使用双大括号转义JSON中的字面量大括号
@@ -405,6 +776,7 @@ def controller_node(state: BlackboardState):
 
 **黑板内容格式说明：**
 黑板上的每个报告都以"**报告来自[代理名称]:**"的格式开头，例如"**报告来自新闻分析师:**"。
+为节省篇幅，黑板上只显示每份报告的摘要（要点、情绪、来源数量），足以判断下一步。
 请仔细检查黑板内容，识别已完成工作的代理名称和他们的贡献。
 
 **已完成的代理和任务：**
@@ -414,7 +786,8 @@ def controller_node(state: BlackboardState):
 1. 仔细阅读用户请求和当前黑板内容
 2. 识别已完成的代理和他们的贡献
 3. 确定还需要完成哪些任务才能满足用户请求
-4. 从可用代理列表中选择单个最佳代理来执行下一步，避免重复调用已经完成工作的代理
+4. 从可用代理列表中选择单个最佳代理来执行下一步，避免重复调用已经完成工作的代理；
+   如果在当前黑板下还有其他代理的工作与它互不依赖，把它们放进also_run，这些代理会并行运行
 5. 如果所有必要信息都已收集，调用"报告撰写者"来综合最终答案
 6. 如果最终报告已撰写完成，选择'FINISH'
 
@@ -432,15 +805,16 @@ def controller_node(state: BlackboardState):
 - 请仔细检查黑板内容中是否包含"**报告来自报告撰写者:**"的格式，如有则必须调用'FINISH'
 
 **输出格式要求：**
-必须严格遵循以下格式，包含且仅包含next_agent和reasoning两个字段：
+必须严格遵循以下格式，包含且仅包含next_agent、also_run和reasoning三个字段：
 ```json
 {{
   "next_agent": "[要调用的代理名称或'FINISH']",
+  "also_run": ["[可并行运行的其他代理名称，没有则为空列表]"],
   "reasoning": "[选择该代理的原因]"
 }}
 ```
 
-其中next_agent必须是可用代理列表中的一个或'FINISH'，reasoning是对选择的简要解释。
+其中next_agent必须是可用代理列表中的一个或'FINISH'，also_run中的代理必须来自可用代理列表，reasoning是对选择的简要解释。
 """
 
     prompt = base_prompt.format(
@@ -453,11 +827,10 @@ def controller_node(state: BlackboardState):
         # 尝试使用结构化输出
         controller_llm = llm.with_structured_output(ControllerDecision)
         decision_result = controller_llm.invoke(prompt)
-        console.print(f"--- 控制器: 决定调用 '{decision_result.next_agent}'。原因：{decision_result.reasoning} ---")
-        return {"next_agent": decision_result.next_agent}
+        console.print(f"--- 控制器: 决定调用 '{decision_result.next_agent}'（并行: {decision_result.also_run}）。原因：{decision_result.reasoning} ---")
+        return {"next_agent": decision_result.next_agent, "also_run": decision_result.also_run}
     except Exception as e:
-        console.print(f"[ERROR] 控制器结构化输出失败: {e}")
-        console.print("[DEBUG] 尝试手动解析控制器响应...")
+        controller_log.warning("控制器结构化输出失败，尝试手动解析: %s", e)
         
         # 备选方案：手动解析JSON响应
         try:
@@ -473,7 +846,6 @@ def controller_node(state: BlackboardState):
             content = content.strip()
             
             # 尝试手动解析JSON响应
-            import json
             decision_data = json.loads(content)
             
             # 验证必填字段是否存在
@@ -488,44 +860,39 @@ def controller_node(state: BlackboardState):
                 raise ValueError(f"无效的代理名称: {decision_data['next_agent']}，必须是{valid_agents}之一")
             
             console.print(f"--- 控制器: 决定调用 '{decision_data['next_agent']}'。原因：{decision_data['reasoning']} ---")
-            return {"next_agent": decision_data['next_agent']}
+            return {"next_agent": decision_data['next_agent'], "also_run": decision_data.get('also_run') or []}
             
         except json.JSONDecodeError as e:
-            console.print(f"[ERROR] 控制器响应JSON解析失败: {e}")
+            controller_log.warning("控制器响应JSON解析失败: %s", e)
         except ValueError as e:
-            console.print(f"[ERROR] 控制器响应字段验证失败: {e}")
+            controller_log.warning("控制器响应字段验证失败: %s", e)
         except Exception as e:
-            console.print(f"[ERROR] 控制器手动解析失败: {e}")
+            controller_log.warning("控制器手动解析失败: %s", e)
         
         # 使用默认值作为降级策略
-        console.print("[ERROR] 控制器无法生成有效决策，使用默认逻辑...")
+        controller_log.error("控制器无法生成有效决策，使用默认逻辑")
         
-        # 基于黑板内容的简单默认逻辑
+        # 基于黑板索引的简单默认逻辑
+        reported = index.get("by_agent", {})
         # 检查是否已有报告撰写者的报告
-        has_writer_report = any("**报告来自报告撰写者:**" in report for report in state['blackboard'])
-        if has_writer_report:
+        if "报告撰写者" in reported:
             console.print("--- 控制器: 检测到报告撰写者已完成，决定调用 'FINISH' ---")
-            return {"next_agent": "FINISH"}
+            return {"next_agent": "FINISH", "fallback": True}
         
         # 检查是否已有技术或财务分析报告
-        has_tech_or_fin_report = any(
-            "**报告来自技术分析师:**" in report or "**报告来自财务分析师:**" in report 
-            for report in state['blackboard']
-        )
-        if has_tech_or_fin_report:
+        if "技术分析师" in reported or "财务分析师" in reported:
             console.print("--- 控制器: 检测到技术或财务分析报告，决定调用 '报告撰写者' ---")
-            return {"next_agent": "报告撰写者"}
+            return {"next_agent": "报告撰写者", "fallback": True}
         
         # 检查是否已有新闻报告
-        has_news_report = any("**报告来自新闻分析师:**" in report for report in state['blackboard'])
-        if has_news_report:
+        if "新闻分析师" in reported:
             # 默认调用技术分析师（积极/中性新闻）
             console.print("--- 控制器: 检测到新闻报告，默认决定调用 '技术分析师' ---")
-            return {"next_agent": "技术分析师"}
+            return {"next_agent": "技术分析师", "fallback": True}
         
         # 默认调用新闻分析师
         console.print("--- 控制器: 黑板为空，默认决定调用 '新闻分析师' ---")
-        return {"next_agent": "新闻分析师"}
+        return {"next_agent": "新闻分析师", "fallback": True}
 
 print("黑板组件和修正的控制器节点已定义。")
 
@@ -549,8 +916,9 @@ bb_graph_builder.add_node("报告撰写者", report_writer_bb)
 bb_graph_builder.set_entry_point("Controller")
 
 # This function defines dynamic routing logic based on Controller's decision
+# 返回多个代理时它们在同一超步中并行运行，全部完成后控制器只被重新进入一次
 def route_to_agent(state: BlackboardState):
- return state["next_agent"]
+ return state.get("next_agents") or [state["next_agent"]]
 
 # Conditional edges route from Controller to chosen specialist or to end
 bb_graph_builder.add_conditional_edges(
@@ -571,7 +939,9 @@ bb_graph_builder.add_edge("技术分析师", "Controller")
 bb_graph_builder.add_edge("财务分析师", "Controller")
 bb_graph_builder.add_edge("报告撰写者", "Controller")
 
-blackboard_app = bb_graph_builder.compile()
+# 每个超步写入SQLite检查点；专家报告昂贵，进程中断后用同一个运行ID恢复即可跳过已完成的专家
+bb_checkpoints = CheckpointStore()
+blackboard_app = bb_graph_builder.compile(checkpointer=bb_checkpoints.saver)
 print("黑板系统编译成功。")
 
 
@@ -587,19 +957,31 @@ console.print(f"[bold green]测试黑板系统在相同的动态查询上:[/bold
 agent_list = ["新闻分析师", "技术分析师", "财务分析师", "报告撰写者"]
 initial_bb_input = {"user_request": dynamic_query, "blackboard": [], "available_agents": agent_list}
 
-# 使用invoke获取最终状态
-final_bb_output = blackboard_app.invoke(initial_bb_input, {"recursion_limit": 10})
+# 运行并获取最终状态；设置BLACKBOARD_RUN_ID可以恢复之前中断的运行
+bb_run_id = os.environ.get("BLACKBOARD_RUN_ID") or new_run_id("blackboard")
+console.print(f"--- 黑板运行ID: {bb_run_id} ---")
+# 预算在控制器内部执行；recursion_limit留出足够余量，只作为最后的安全网
+bb_run_config = {"recursion_limit": 2 * BLACKBOARD_MAX_CYCLES + 6}
+try:
+    final_bb_output = bb_checkpoints.run(blackboard_app, bb_run_id, initial_bb_input, bb_run_config, app_name="blackboard")
+except GraphRecursionError:
+    # 从最后一个检查点取回已完成的工作，而不是全部丢弃
+    final_bb_output = {**blackboard_app.get_state(CheckpointStore.config(bb_run_id)).values, "termination_reason": "recursion_limit"}
+console.print(f"--- 黑板运行结束原因: {final_bb_output.get('termination_reason')}, 周期数: {final_bb_output.get('cycle')} ---")
 # 美观打印黑板中的每个报告
 console.print("\n--- [bold purple]最终黑板状态[/bold purple] ---")
-for  i, report in enumerate(final_bb_output.get('blackboard', [])):
+for  i, entry in enumerate(final_bb_output.get('blackboard', [])):
     console.print(f"--- 报告 {i+1} ---")
-    console.print(Markdown(report))
+    console.print(Markdown(render_entry(entry)))
     console.print("\n")
 
 console.print("\n--- [bold green]黑板系统最终报告[/bold green] ---")
-# 最终报告是撰写者发布到黑板的最后一项
-final_report_content = final_bb_output['blackboard'][-1]
-console.print(Markdown(final_report_content))
+# 最终报告是撰写者发布到黑板的最新final_report条目
+# 预算提前结束时可能没有最终报告，此时展示黑板上最新的条目
+final_report_entry = latest_entry(final_bb_output.get('blackboard_index') or {}, kind="final_report") or (final_bb_output['blackboard'] or [None])[-1]
+console.print(Markdown(final_report_entry['body'] if final_report_entry else "黑板为空，没有可用的报告。"))
+controller_log.info("控制器决策统计: %s", controller_stats)
+specialist_log.info("专家耗时统计: %s", specialist_timings)
 
 
 # **修正后输出的讨论：**
@@ -636,7 +1018,7 @@ def evaluate_agent_logic(query: str, final_state: dict):
  agent_type = "Unknown"
  if 'blackboard' in final_state: # Blackboard agent
      agent_type = "Blackboard"
-     trace = "\n---\n".join(final_state['blackboard'])
+     trace = "\n---\n".join(render_entry(entry) for entry in final_state['blackboard'])
  else: # Sequential agent
      agent_type = "Sequential"
      trace = f"1. News Report Generated: {final_state.get('news_report')}\n---\n2. Technical Report Generated: {final_state.get('technical_report')}\n---\n3. Financial Report Generated: {final_state.get('financial_report')}"
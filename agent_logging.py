@@ -0,0 +1,131 @@
+# coding: utf-8
+"""分级、惰性、异步的日志设施。
+
+各架构脚本原来用 ``console.print`` 无条件输出完整的黑板内容、报告和模型原始响应，
+终端的Rich渲染成了运行时间中可观的一部分。这里提供统一的日志入口：
+
+- 按组件分级：``get_logger("blackboard.controller")``，每个组件可单独设置级别；
+- 惰性格式化：使用 ``%`` 风格参数（``logger.debug("内容: %s", text)``），昂贵的计算用 ``lazy(...)`` 包装，
+  级别未启用时既不格式化也不计算；
+- 异步写出：日志记录先进入队列，由后台线程写入文件，调用方不等待磁盘I/O；
+- 可选的Rich控制台输出，默认关闭。
+
+环境变量（也可以直接传给 ``configure_logging``）::
+
+    AGENT_LOG_LEVEL=INFO                                   # 默认级别
+    AGENT_LOG_LEVELS=blackboard.controller=DEBUG,pev=WARNING  # 按组件覆盖
+    AGENT_LOG_FILE=agents.log                              # 文件路径
+    AGENT_LOG_CONSOLE=1                                    # 同时输出到Rich控制台
+
+用法::
+
+    from agent_logging import get_logger, lazy
+    log = get_logger("blackboard.controller")
+    log.debug("黑板内容:\\n%s", lazy(lambda: "\\n".join(entries)))
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from typing import Callable, Dict, Optional
+
+ROOT_LOGGER_NAME = "agents"
+
+_lock = threading.Lock()
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class lazy:
+    """延迟求值的日志参数：只有在记录真正被格式化时才调用函数。"""
+
+    __slots__ = ("_func",)
+
+    def __init__(self, func: Callable[[], object]):
+        self._func = func
+
+    def __str__(self):
+        return str(self._func())
+
+    def __repr__(self):
+        return repr(self._func())
+
+
+def _parse_component_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(log_file: Optional[str] = None, level: Optional[str] = None,
+                      component_levels: Optional[Dict[str, str]] = None, console: Optional[bool] = None):
+    """配置 ``agents`` 日志树：队列 + 后台文件写出，可选Rich控制台。重复调用只会重新设置级别。"""
+    global _listener
+    level = (level or os.environ.get("AGENT_LOG_LEVEL", "INFO")).upper()
+    if component_levels is None:
+        component_levels = _parse_component_levels(os.environ.get("AGENT_LOG_LEVELS", ""))
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(level)
+    for name, component_level in component_levels.items():
+        logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}").setLevel(component_level)
+
+    with _lock:
+        if _listener is not None:
+            return root
+        if console is None:
+            console = os.environ.get("AGENT_LOG_CONSOLE", "0") == "1"
+        handlers = []
+        file_handler = logging.FileHandler(log_file or os.environ.get("AGENT_LOG_FILE", "agents.log"), encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(threadName)s: %(message)s"))
+        handlers.append(file_handler)
+        if console:
+            from rich.logging import RichHandler
+            handlers.append(RichHandler(show_path=False, markup=False))
+
+        # 无界队列：调用方只做入队，格式化和I/O都在监听线程中完成
+        log_queue = queue.SimpleQueue()
+        for handler in [h for h in root.handlers if isinstance(h, _DeferredQueueHandler)]:
+            root.removeHandler(handler)
+        root.addHandler(_DeferredQueueHandler(log_queue))
+        # 不向根logger传播，避免与各脚本的basicConfig文件重复写入
+        root.propagate = False
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+    return root
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """把格式化推迟到监听线程的QueueHandler。
+
+    标准QueueHandler在入队前调用 ``prepare`` 格式化消息；这里只把 ``lazy`` 参数和异常信息
+    在当前线程求值成字符串（保证状态在入队时刻的快照），完整的格式化留给后台线程。
+    """
+
+    def prepare(self, record):
+        if isinstance(record.args, tuple):
+            record.args = tuple(str(a) if isinstance(a, lazy) else a for a in record.args)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def shutdown_logging():
+    """停止后台监听线程并刷新所有待写出的记录。"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(component: str) -> logging.Logger:
+    """返回组件logger（``agents.<component>``），首次调用时按环境变量完成配置。"""
+    if _listener is None:
+        configure_logging()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{component}")
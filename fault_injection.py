@@ -0,0 +1,135 @@
+# coding: utf-8
+"""可配置的工具故障注入。
+
+``FaultInjector`` 可以包装任意 ``query -> str`` 形式的工具函数，按 ``FaultProfile`` 注入：
+失败响应、限流响应、格式错误的载荷、超时以及按分布采样的额外延迟。
+所有随机性都来自带种子的 ``random.Random``，相同的种子和调用顺序会得到相同的故障序列。
+
+失败以工具的约定返回：以 ``"error:"`` 开头的字符串；超时则抛出 ``TimeoutError``。
+
+用法::
+
+    from fault_injection import FaultInjector, FAULT_PROFILES
+    search = FaultInjector(raw_web_search, FAULT_PROFILES["flaky"], seed=42)
+    search("Apple R&D spend")
+"""
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class LatencyDistribution(BaseModel):
+    """额外注入延迟的分布（毫秒）。"""
+    kind: str = Field(default="none", description="'none'、'fixed'、'uniform'或'lognormal'之一。")
+    value_ms: float = Field(default=0.0, description="fixed的延迟，或uniform的下限。")
+    high_ms: float = Field(default=0.0, description="uniform的上限。")
+    median_ms: float = Field(default=0.0, description="lognormal的中位数。")
+    sigma: float = Field(default=0.5, description="lognormal的形状参数，越大尾部越长。")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.value_ms
+        if self.kind == "uniform":
+            return rng.uniform(self.value_ms, self.high_ms)
+        if self.kind == "lognormal" and self.median_ms > 0:
+            return rng.lognormvariate(0.0, self.sigma) * self.median_ms
+        return 0.0
+
+
+class FaultProfile(BaseModel):
+    """一组故障注入参数。各类故障按顺序互斥抽样，概率之和应不超过1。"""
+    name: str
+    failure_rate: float = Field(default=0.0, description="返回服务端错误（5xx）的概率。")
+    rate_limit_rate: float = Field(default=0.0, description="返回限流响应（429）的概率。")
+    malformed_rate: float = Field(default=0.0, description="返回被截断、格式错误载荷的概率。")
+    timeout_rate: float = Field(default=0.0, description="等待timeout_seconds后抛出TimeoutError的概率。")
+    timeout_seconds: float = 2.0
+    latency: LatencyDistribution = Field(default_factory=LatencyDistribution)
+    match_keywords: List[str] = Field(default_factory=list, description="非空时只对包含这些关键词的查询注入故障。")
+    failure_message: str = "error: 503 Service Unavailable. 上游服务暂时不可用."
+
+
+FAULT_PROFILES: Dict[str, FaultProfile] = {
+    "none": FaultProfile(name="none"),
+    # 原notebook中的场景：员工数量查询的端点一直不可用
+    "employee_count_outage": FaultProfile(
+        name="employee_count_outage",
+        failure_rate=1.0,
+        match_keywords=["employee count"],
+        failure_message="error: Could not retrieve data. API端点当前不可用.",
+    ),
+    "flaky": FaultProfile(name="flaky", failure_rate=0.2),
+    "rate_limited": FaultProfile(name="rate_limited", rate_limit_rate=0.3),
+    "malformed": FaultProfile(name="malformed", malformed_rate=0.2),
+    "slow": FaultProfile(name="slow", latency=LatencyDistribution(kind="lognormal", median_ms=800, sigma=0.8)),
+    "timeouts": FaultProfile(name="timeouts", timeout_rate=0.1, timeout_seconds=3.0),
+    "degraded": FaultProfile(
+        name="degraded",
+        failure_rate=0.1,
+        rate_limit_rate=0.1,
+        malformed_rate=0.05,
+        timeout_rate=0.05,
+        latency=LatencyDistribution(kind="lognormal", median_ms=300, sigma=0.6),
+    ),
+}
+
+
+class FaultInjector:
+    """包装一个工具函数并按故障配置注入故障，线程安全。"""
+
+    def __init__(self, func: Callable[[str], str], profile: FaultProfile = FAULT_PROFILES["none"], seed: int = 0):
+        self.func = func
+        self._lock = threading.Lock()
+        self.configure(profile, seed)
+
+    def configure(self, profile: FaultProfile, seed: Optional[int] = None):
+        """切换故障配置并（可选）重新设定种子，同时清零统计。
+        统计中的repeat_calls是对同一查询的重复调用次数（本地重试或重新规划重复了查询），与调用方如何重试无关。"""
+        with self._lock:
+            self.profile = profile
+            if seed is not None:
+                self.seed = seed
+                self._rng = random.Random(seed)
+            self.stats = {"calls": 0, "repeat_calls": 0, "failure": 0, "rate_limit": 0, "malformed": 0, "timeout": 0, "injected_latency_ms": 0.0}
+            self._seen_queries = set()
+
+    def _draw(self, query: str):
+        """在锁内一次性抽取本次调用的延迟和故障类型，保证可复现。"""
+        with self._lock:
+            self.stats["calls"] += 1
+            if query in self._seen_queries:
+                self.stats["repeat_calls"] += 1
+            self._seen_queries.add(query)
+            profile = self.profile
+            latency_ms = profile.latency.sample(self._rng)
+            self.stats["injected_latency_ms"] += latency_ms
+            if profile.match_keywords and not any(k in query.lower() for k in profile.match_keywords):
+                return latency_ms, None
+            roll = self._rng.random()
+            for kind, rate in (("failure", profile.failure_rate), ("rate_limit", profile.rate_limit_rate),
+                               ("malformed", profile.malformed_rate), ("timeout", profile.timeout_rate)):
+                if roll < rate:
+                    self.stats[kind] += 1
+                    return latency_ms, kind
+                roll -= rate
+            return latency_ms, None
+
+    def __call__(self, query: str) -> str:
+        latency_ms, fault = self._draw(query)
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        if fault == "failure":
+            return self.profile.failure_message
+        if fault == "rate_limit":
+            return "error: 429 Too Many Requests. Rate limit exceeded, retry later."
+        if fault == "timeout":
+            time.sleep(self.profile.timeout_seconds)
+            raise TimeoutError(f"工具调用在 {self.profile.timeout_seconds}s 后超时")
+        result = self.func(query)
+        if fault == "malformed":
+            # 截断真实载荷，模拟不完整或损坏的响应
+            return result[: max(1, len(result) // 3)]
+        return result
@@ -0,0 +1,93 @@
+# coding: utf-8
+"""报告撰写者的流式输出。
+
+多代理（05）和黑板（07）脚本的报告撰写者都用这里的 ``stream_report`` 生成报告：
+令牌逐个流出，每完成一个markdown小节就通过LangGraph的自定义流发出一个结构化事件，
+并记录首令牌（TTFT）和末令牌（TTLT）时间。``stream_with_report_events`` 是对应的消费端，
+用 ``messages``/``custom``/``values`` 三种流模式运行图，实时打印撰写者的令牌和小节事件。
+
+事件格式::
+
+    {"event": "first_token", "node": ..., "ttft": ...}
+    {"event": "section_complete", "node": ..., "index": ..., "title": ..., "content": ..., "elapsed": ...}
+    {"event": "report_complete", "node": ..., "ttft": ..., "ttlt": ..., "sections": ...}
+
+用法::
+
+    from report_streaming import stream_report, stream_with_report_events
+    report, timing = stream_report(llm, prompt, "report_writer")   # 在图节点内部调用
+    final_state = stream_with_report_events(app, graph_input, config, writer_node="report_writer")
+"""
+import time
+from typing import Optional
+
+from langgraph.config import get_stream_writer
+from rich.console import Console
+
+
+def stream_report(llm, prompt: str, node_name: str) -> tuple:
+    """流式生成报告：每完成一个markdown小节就发出一个结构化事件，并记录首/末令牌时间。
+    返回(完整报告文本, 计时信息)。必须在图节点内部调用。"""
+    writer = get_stream_writer()
+    start = time.perf_counter()
+    ttft = None
+    chunks = []
+    line_buffer = ""
+    section = {"title": "引言", "lines": []}
+    sections_emitted = 0
+
+    def emit_section():
+        nonlocal sections_emitted
+        content = "\n".join(section["lines"]).strip()
+        if not content:
+            return
+        writer({"event": "section_complete", "node": node_name, "index": sections_emitted, "title": section["title"], "content": content, "elapsed": time.perf_counter() - start})
+        sections_emitted += 1
+
+    def consume_line(line: str):
+        # 新的markdown标题意味着上一个小节已经完成
+        if line.lstrip().startswith("#"):
+            emit_section()
+            section["title"] = line.strip().lstrip("#").strip()
+            section["lines"] = [line]
+        else:
+            section["lines"].append(line)
+
+    for chunk in llm.stream(prompt):
+        if not chunk.content:
+            continue
+        if ttft is None:
+            ttft = time.perf_counter() - start
+            writer({"event": "first_token", "node": node_name, "ttft": ttft})
+        chunks.append(chunk.content)
+        line_buffer += chunk.content
+        *complete_lines, line_buffer = line_buffer.split("\n")
+        for line in complete_lines:
+            consume_line(line)
+    if line_buffer:
+        consume_line(line_buffer)
+    emit_section()
+
+    timing = {"ttft": ttft, "ttlt": time.perf_counter() - start, "sections": sections_emitted}
+    writer({"event": "report_complete", "node": node_name, **timing})
+    return "".join(chunks), timing
+
+
+def stream_with_report_events(app, graph_input: Optional[dict], config: Optional[dict] = None,
+                              writer_node: str = "report_writer", console: Optional[Console] = None) -> dict:
+    """通过图的stream API运行：实时打印撰写者节点的令牌和小节事件，返回最终状态。"""
+    console = console or Console()
+    final_state = {}
+    for mode, payload in app.stream(graph_input, config, stream_mode=["messages", "custom", "values"]):
+        if mode == "messages":
+            message_chunk, metadata = payload
+            if metadata.get("langgraph_node") == writer_node and message_chunk.content:
+                console.print(message_chunk.content, end="", markup=False, highlight=False)
+        elif mode == "custom":
+            if payload.get("event") == "section_complete":
+                console.print(f"\n[dim]--- 小节完成 #{payload['index']}: {payload['title']} ({payload['elapsed']:.1f}s) ---[/dim]")
+            elif payload.get("event") == "report_complete":
+                console.print(f"\n[dim]--- 报告完成: 首令牌 {payload['ttft'] or 0:.2f}s, 末令牌 {payload['ttlt']:.2f}s ---[/dim]")
+        else:
+            final_state = payload
+    return final_state
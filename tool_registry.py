@@ -0,0 +1,226 @@
+# coding: utf-8
+"""进程级工具注册表。
+
+所有架构脚本都通过这里获取工具，而不是在热路径上反复构造客户端：
+- 每个工具只构造一次（包括参数校验和API密钥解析），之后复用同一个实例；
+- ``bind`` 缓存 ``llm.bind_tools(...)`` 的结果，避免每次调用都重新绑定；
+- ``http_client`` 提供一个共享的、带keep-alive连接池的HTTP客户端，供模型客户端复用连接；
+- 工具的API封装（例如Tavily）通过模块级 ``requests.post`` 发请求，每次调用都新建连接。构造这类工具时，
+  注册表把封装模块里的 ``requests`` 换成共享的 ``requests.Session``（接口相同、带连接池），
+  并在后台向API主机发一次请求预热连接，之后的工具调用复用这条keep-alive连接；
+- 通过回调记录每个工具的调用延迟和错误，``health_check`` 汇总每个工具的健康状态。
+
+用法::
+
+    from tool_registry import tool_registry
+    search_tool = tool_registry.get("tavily_search", lambda: TavilySearch(max_results=2))
+    llm_with_tools = tool_registry.bind(llm, [search_tool])
+
+同一个名字只能对应一种构造方式：用不同的工厂（例如不同的工具类或参数）重复注册同一个名字会抛出
+``ValueError``，不同配置的工具应使用不同的名字。
+"""
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+def _factory_signature(factory: Callable[[], Any]):
+    """工厂的可比较签名：字节码、常量、引用的名字、默认参数和闭包内容。
+    重新执行同一段代码（例如notebook重跑单元格）得到的新lambda与原来的签名相同。"""
+    code = getattr(factory, "__code__", None)
+    if code is None:
+        return factory
+    closure = []
+    for cell in factory.__closure__ or ():
+        try:
+            closure.append(cell.cell_contents)
+        except ValueError:
+            closure.append(None)
+    return (code.co_code, code.co_consts, code.co_names, factory.__defaults__, tuple(closure))
+
+
+class _ToolLatencyHandler(BaseCallbackHandler):
+    """记录工具调用延迟的回调，ToolNode、bind_tools链和直接invoke都会经过它。"""
+
+    def __init__(self, registry: "ToolRegistry", name: str):
+        self._registry = registry
+        self._name = name
+        self._starts = {}
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self._registry._record(self._name, time.perf_counter() - start, None)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        self._registry._record(self._name, time.perf_counter() - start if start is not None else 0.0, error)
+
+
+class ToolRegistry:
+    """线程安全的工具注册表，每个名字对应一个只构造一次的工具实例。"""
+
+    def __init__(self, max_samples: int = 1000):
+        self._lock = threading.RLock()
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._probes: Dict[str, Callable[[Any], Any]] = {}
+        self._tools: Dict[str, Any] = {}
+        self._bindings: Dict[tuple, tuple] = {}
+        self._latencies: Dict[str, deque] = {}
+        self._counters: Dict[str, dict] = {}
+        self._max_samples = max_samples
+        self._http_client = None
+        self._http_session = None
+        self._warmed_hosts = set()
+
+    def register(self, name: str, factory: Callable[[], Any], probe: Optional[Callable[[Any], Any]] = None):
+        """注册工具工厂；同一工厂重复注册是幂等的，同名但工厂不同则抛出ValueError。"""
+        with self._lock:
+            existing = self._factories.get(name)
+            if existing is None:
+                self._factories[name] = factory
+            elif existing is not factory and _factory_signature(existing) != _factory_signature(factory):
+                raise ValueError(f"工具 '{name}' 已用不同的工厂注册，不同配置的工具请使用不同的名字")
+            if probe is not None:
+                self._probes.setdefault(name, probe)
+
+    def get(self, name: str, factory: Optional[Callable[[], Any]] = None, probe: Optional[Callable[[Any], Any]] = None):
+        """返回工具实例，首次访问时构造并挂上延迟统计回调。"""
+        with self._lock:
+            if factory is not None:
+                self.register(name, factory, probe)
+            tool = self._tools.get(name)
+            if tool is not None:
+                return tool
+            if name not in self._factories:
+                raise KeyError(f"工具 '{name}' 未注册")
+            tool = self._factories[name]()
+            handler = _ToolLatencyHandler(self, name)
+            if hasattr(tool, "callbacks"):
+                existing = tool.callbacks or []
+                tool.callbacks = (list(existing) if isinstance(existing, list) else [existing]) + [handler]
+            self._tools[name] = tool
+            self._pool_tool_connections(tool)
+            self._latencies[name] = deque(maxlen=self._max_samples)
+            self._counters[name] = {"calls": 0, "errors": 0, "last_error": None, "built_at": time.time()}
+            return tool
+
+    def bind(self, llm, tools: List[Any], **kwargs):
+        """缓存 ``llm.bind_tools(tools)``，同一个模型和工具组合只绑定一次。"""
+        key = (id(llm), tuple(id(t) for t in tools), tuple(sorted(kwargs.items())))
+        with self._lock:
+            cached = self._bindings.get(key)
+            if cached is None:
+                # 同时保存llm和工具的引用，防止id被回收复用
+                cached = (llm.bind_tools(tools, **kwargs), llm, tuple(tools))
+                self._bindings[key] = cached
+            return cached[0]
+
+    def http_client(self):
+        """共享的HTTP客户端：连接池 + keep-alive，传给 ``ChatOpenAI(http_client=...)`` 复用连接。"""
+        with self._lock:
+            if self._http_client is None:
+                import httpx
+                self._http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+                    timeout=httpx.Timeout(60.0, connect=10.0),
+                )
+            return self._http_client
+
+    def http_session(self):
+        """共享的 ``requests.Session``：同步工具封装的HTTP请求经过它复用keep-alive连接。"""
+        with self._lock:
+            if self._http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._http_session = session
+            return self._http_session
+
+    def _pool_tool_connections(self, tool):
+        """工具的API封装模块直接调用 ``requests.post/get`` 时，换成共享会话并预热到API主机的连接。"""
+        wrapper = getattr(tool, "api_wrapper", None)
+        module = sys.modules.get(type(wrapper).__module__) if wrapper is not None else None
+        if module is None:
+            return
+        import requests
+        current = getattr(module, "requests", None)
+        if current is requests:
+            module.requests = self.http_session()
+        elif current is not self._http_session:
+            return
+        base_url = getattr(wrapper, "api_base_url", None) or getattr(module, "TAVILY_API_URL", None)
+        if base_url and base_url not in self._warmed_hosts:
+            self._warmed_hosts.add(base_url)
+            # 预热只为建立TCP/TLS连接，响应内容和失败都不重要；放在后台，不拖慢工具构造
+            threading.Thread(target=self._warm, args=(base_url,), name="tool-warmup", daemon=True).start()
+
+    def _warm(self, base_url: str):
+        try:
+            self.http_session().head(base_url, timeout=5)
+        except Exception:
+            pass
+
+    def _record(self, name: str, seconds: float, error: Optional[BaseException]):
+        with self._lock:
+            self._latencies[name].append(seconds)
+            counters = self._counters[name]
+            counters["calls"] += 1
+            if error is not None:
+                counters["errors"] += 1
+                counters["last_error"] = repr(error)
+
+    def latency_stats(self) -> Dict[str, dict]:
+        """每个工具的调用次数、错误数和延迟分位数（秒）。"""
+        with self._lock:
+            stats = {}
+            for name, samples in self._latencies.items():
+                ordered = sorted(samples)
+                counters = self._counters[name]
+                stats[name] = {
+                    "calls": counters["calls"],
+                    "errors": counters["errors"],
+                    "mean": sum(ordered) / len(ordered) if ordered else None,
+                    "p50": ordered[len(ordered) // 2] if ordered else None,
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+                    "max": ordered[-1] if ordered else None,
+                }
+            return stats
+
+    def health_check(self, name: Optional[str] = None) -> Dict[str, dict]:
+        """检查工具健康状态：已构造、错误率，以及注册了探针的工具的探针结果。"""
+        with self._lock:
+            names = [name] if name else list(self._factories)
+            snapshot = {tool_name: (tool_name in self._tools, dict(self._counters.get(tool_name) or {}), self._probes.get(tool_name)) for tool_name in names}
+        report = {}
+        # 探针可能发起网络调用，在锁外执行
+        for tool_name, (built, counters, probe) in snapshot.items():
+            entry = {"built": built}
+            if counters:
+                entry["error_rate"] = counters["errors"] / counters["calls"] if counters["calls"] else 0.0
+                entry["last_error"] = counters["last_error"]
+            if probe is not None:
+                start = time.perf_counter()
+                try:
+                    probe(self.get(tool_name))
+                    entry["probe"] = "ok"
+                except Exception as e:
+                    entry["probe"] = f"failed: {e}"
+                entry["probe_seconds"] = time.perf_counter() - start
+            entry["healthy"] = entry.get("probe", "ok") == "ok" and entry.get("error_rate", 0.0) < 0.5
+            report[tool_name] = entry
+        return report
+
+
+# 进程级单例
+tool_registry = ToolRegistry()